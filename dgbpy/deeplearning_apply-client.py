@@ -70,6 +70,12 @@ parser.add_argument( '--fakeapply', dest='fakeapply', action='store_true',
 parser.add_argument( '--local', dest='localserv', action='store_true',
                      default=False,
                      help="use a local network socket connection" )
+parser.add_argument( '--sharedmem', dest='sharedmem', action='store_true',
+                     default=False,
+                     help="pass the arrays in shared memory (requires --local)" )
+parser.add_argument( '--keepalive', dest='keepalive', action='store_true',
+                     default=False,
+                     help="send all requests over a single persistent connection" )
 
 
 args = vars(parser.parse_args())
@@ -96,6 +102,8 @@ if args['fakeapply']:
   servercmd.append( '--fakeapply' )
 if local:
   servercmd.append( '--local' )
+if args['keepalive']:
+  servercmd.append( '--keepalive' )
 
 serverproc = oscommand.execCommand( servercmd, background=True )
 time.sleep( 2 )
@@ -116,6 +124,12 @@ def create_request(action, value=None):
       encoding="utf-8",
       content=dict(action=action),
     )
+  elif action == 'handshake':
+    return dict(
+      type="text/json",
+      encoding="utf-8",
+      content=dict(action=action, value=value),
+    )
   elif action == 'outputs':
     return dict(
       type="text/json",
@@ -134,7 +148,7 @@ def create_request(action, value=None):
   elif action == 'data':
     arr = getApplyTrace(value)
     return dict(
-      type='binary/array',
+      type='shm/array' if local and args['sharedmem'] else 'binary/array',
       encoding=[arr.dtype.name],
       content=[arr],
     )
@@ -209,8 +223,11 @@ inpdata = inpdata.astype('float32')
 start = time.time()
 
 host,port = args['addr'], args['port']
-req_connection(host, port, create_request('status'))
-req_connection(host, port, create_request('outputs',pars['outputnms']))
+requests = list()
+if args['keepalive']:
+  requests.append( create_request('handshake', {'protocol': 2, 'keepalive': True}) )
+requests.append( create_request('status') )
+requests.append( create_request('outputs',pars['outputnms']) )
 applydict = {
   'arr': inpdata,
   'inp_shape': shape,
@@ -226,9 +243,14 @@ for i in range(nrrepeats):
   applydict['idx'] = i
   for idy in range(0,nrtrcs_in-shape[1]+1,chunk_step):
     applydict['idy'] = idy
-    req_connection(host, port, create_request('data',applydict))
+    requests.append( create_request('data',applydict) )
 
-req_connection(host, port, create_request('kill'))
+requests.append( create_request('kill') )
+if args['keepalive']:
+  req_connection(host, port, requests)
+else:
+  for request in requests:
+    req_connection(host, port, request)
 
 try:
   while True:
@@ -53,6 +53,27 @@ parser.add_argument( '--fakeapply', dest='fakeapply', action='store_true',
 parser.add_argument( '--local', dest='localserv', action='store_true',
                      default=False,
                      help="use a local network socket connection" )
+parser.add_argument( '--microbatch', dest='microbatch', action='store',
+                     type=int, default=0,
+                     help="apply concurrent requests together, up to this number of samples" )
+parser.add_argument( '--microbatch-delay', dest='microbatchdelay', action='store',
+                     type=float, default=5,
+                     help="maximum time in ms a request waits for others to be applied with" )
+parser.add_argument( '--keepalive', dest='keepalive', action='store_true',
+                     default=False,
+                     help="allow persistent connections after a handshake" )
+parser.add_argument( '--async', dest='asyncserv', action='store_true',
+                     default=False,
+                     help="serve with asyncio, applying the model on a worker thread" )
+parser.add_argument( '--max-pending', dest='maxpending', action='store',
+                     type=int, default=4,
+                     help="maximum number of requests received ahead of their response (with --async)" )
+parser.add_argument( '--max-payload', dest='maxpayload', action='store',
+                     type=int, default=1024,
+                     help="maximum size in MB of a request, larger requests close their connection" )
+parser.add_argument( '--workers', dest='nbworkers', action='store',
+                     type=int, default=1,
+                     help="number of server processes accepting on the same socket (POSIX only)" )
 
 args = vars(parser.parse_args())
 from odpy.common import *
@@ -60,9 +81,9 @@ initLogging( args )
 redirect_stdout()
 
 # Start listening as quickly as possible
+import os
 import selectors
 import socket
-sel = selectors.DefaultSelector()
 local = args['localserv']
 host,port = args['addr'], args['port']
 if local:
@@ -88,13 +109,31 @@ except Exception as e:
   log_msg( e )
   raise e
 std_msg("listening on", addr)
-lsock.setblocking(True)
+
+# Pre-fork the workers: each one loads the model and accepts on the inherited socket
+workerpids = list()
+nbworkers = args['nbworkers']
+if nbworkers > 1 and not hasattr(os, 'fork'):
+  log_msg( 'Multiple workers are not supported on this platform, using a single one' )
+  nbworkers = 1
+for iworker in range(1, nbworkers):
+  pid = os.fork()
+  if pid == 0:
+    workerpids = None
+    break
+  workerpids.append( pid )
+ismaster = workerpids != None
+if nbworkers > 1:
+  std_msg( 'worker', os.getpid(), 'started' )
+
+sel = selectors.DefaultSelector()
+# Concurrent workers may lose the race for a connection
+lsock.setblocking(nbworkers < 2)
 sel.register(lsock, selectors.EVENT_READ, data=None)
 
 
 # Keep all lengthy operations below
 import numpy as np
-import os
 import psutil
 import signal
 import threading
@@ -102,20 +141,33 @@ import traceback
 
 from odpy.common import Timer
 import dgbpy.deeplearning_apply_serverlib as applylib
+applylib.maxpayloadsize = args['maxpayload'] * 1024 * 1024
 
 
 def signal_handler(signal, frame):
   raise applylib.ExitCommand()
 signal.signal(signal.SIGINT,signal_handler)
 
+# The processes of a pool stop each other with a signal of their own
+poolsignal = signal.SIGTERM
+def pool_signal_handler(signal, frame):
+  raise applylib.PoolShutdown()
+if nbworkers > 1:
+  signal.signal(poolsignal,pool_signal_handler)
+
 def timerCB():
   if not parentproc.is_running():
     os.kill( psutil.Process().pid, signal.SIGINT )
 
 def accept_wrapper(sock,applier):
-  conn, addr = sock.accept()  # Should be ready to read
+  try:
+    conn, addr = sock.accept()  # Should be ready to read
+  except BlockingIOError:
+    # Accepted by another worker
+    return
   conn.setblocking(True)
-  message = applylib.Message(sel, conn, addr, applier)
+  message = applylib.Message(sel, conn, addr, applier, keepalive=args['keepalive'],
+                             sharedmem=local, scheduler=scheduler)
   sel.register(conn, selectors.EVENT_READ, data=message)
 
 timer = Timer(15, timerCB)
@@ -124,16 +176,31 @@ if 'parentpid' in args:
   ppid = args['parentpid']
   if ppid > 0:
     parentproc = psutil.Process( ppid )
-    timer.start()
+if parentproc == None and not ismaster:
+  parentproc = psutil.Process( os.getppid() )
+if parentproc != None:
+  timer.start()
 
 applier = None
+scheduler = None
+lastmessage = False
 try:
   if applier == None:
     applier = applylib.ModelApplier( args['modelfile'].name, args['applydir'], args['fakeapply'] )
-  lastmessage = False
+  if args['microbatch'] > 0:
+    scheduler = applylib.BatchScheduler( applier, args['microbatch'], args['microbatchdelay']/1000 )
   cont = True
+  if args['asyncserv']:
+    sel.unregister(lsock)
+    applylib.serveAsync( lsock, applier, local=local, keepalive=args['keepalive'],
+                         maxpending=args['maxpending'] )
+    lastmessage = True
+    cont = False
   while cont:
-    events = sel.select(timeout=300)
+    timeout = 300
+    if scheduler and scheduler.timeout() != None:
+      timeout = scheduler.timeout()
+    events = sel.select(timeout=timeout)
     for key, mask in events:
       if key.data is None:
         accept_wrapper(key.fileobj,applier)
@@ -153,11 +220,27 @@ try:
           cont = False
         if cont:
           applier = message.applier
+    if scheduler and scheduler.ready():
+      scheduler.flush()
 except KeyboardInterrupt:
   std_msg('caught keyboard interrupt, exiting')
+except applylib.PoolShutdown:
+  std_msg('Server pool stopped by another process, exiting')
 except applylib.ExitCommand:
   std_msg('Found dead parent, exiting')
 finally:
+  if nbworkers > 1:
+    signal.signal(poolsignal,signal.SIG_IGN)
   timer.cancel()
   sel.close()
+  if not ismaster and lastmessage:
+    # Stop the whole pool
+    os.kill( os.getppid(), poolsignal )
+  elif ismaster:
+    for pid in workerpids:
+      try:
+        os.kill( pid, poolsignal )
+        os.waitpid( pid, 0 )
+      except OSError:
+        pass
 
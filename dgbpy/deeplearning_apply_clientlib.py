@@ -16,22 +16,34 @@ import struct
 
 from odpy.common import *
 
+# Size of the reads until the OD header of a response is known: the payload
+# itself is then received directly into a buffer of its final size.
+recvheadersize = 65536
 
 class Message:
     def __init__(self, selector, sock, addr, request):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
+        self._recv_buffer = bytearray()
         self._send_buffer = b""
+        self._reset_response()
+        # A list of requests is pipelined over a single persistent connection
+        self.requests = request if isinstance(request, list) else [request]
+        self.request = self.requests[0]
+        self.responses = list()
+        self._request_queued = False
+        self._shms = dict()
+
+    def _reset_response(self):
         self._payload_len = None
         self._reqid = None
         self._subid = None
         self._jsonheader_len = None
         self.jsonheader = None
         self.response = None
-        self.request = request
-        self._request_queued = False
+        self._payload = None
+        self._payload_pos = 0
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -48,14 +60,18 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(16777216)
+            if self._payload is None:
+                data = self.sock.recv(recvheadersize)
+                self._recv_buffer += data
+            else:
+                # Payload size is known: receive in place, without any copy
+                data = self.sock.recv_into(self._payload[self._payload_pos:])
+                self._payload_pos += data
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not data:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
@@ -90,6 +106,28 @@ class Message:
           shapes.append( obj.shape )
         return (ret,shapes)
 
+    def _shm_encode(self, objs, ireq):
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory( create=True, size=max(1,sum([obj.nbytes for obj in objs])) )
+        self._shms[ireq] = shm
+        shapes = list()
+        offset = 0
+        for obj in objs:
+          np.ndarray( obj.shape, dtype=obj.dtype, buffer=shm.buf, offset=offset )[...] = obj
+          offset += obj.nbytes
+          shapes.append( obj.shape )
+        return (shm.name,shapes)
+
+    def _shm_decode(self, shmname, shapes, dtypes):
+        # The client owns the result segment: copy the arrays, and remove it
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory( name=shmname )
+        ret = self._array_decode(shm.buf,shapes,dtypes)
+        ret['data'] = [np.array(arr) for arr in ret['data']]
+        shm.close()
+        shm.unlink()
+        return ret
+
     def _array_decode(self, arrptr, shapes, dtypes):
         ret = list()
         offset = 0
@@ -105,7 +143,7 @@ class Message:
         }
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding, arrsize
+        self, *, content_bytes, content_type, content_encoding, arrsize, shmname=None
     ):
         jsonheader = {
             'byteorder': sys.byteorder,
@@ -115,6 +153,8 @@ class Message:
         }
         if arrsize != None:
           jsonheader.update({ 'array-shape': arrsize })
+        if shmname != None:
+          jsonheader.update({ 'shm-name': shmname })
         jsonheader_bytes = self._json_encode(jsonheader, 'utf-8')
         od_hdr =   struct.pack('=i',len(jsonheader_bytes)+len(content_bytes)) \
                  + struct.pack('=i',1) \
@@ -143,11 +183,13 @@ class Message:
 
     def read(self):
         self._read()
+        self._process_recv_buffer()
 
-        if self._jsonheader_len is None:
+    def _process_recv_buffer(self):
+        if self._payload_len is None:
             self.process_protoheader()
 
-        if self._jsonheader_len is not None:
+        if self._payload_len is not None:
             if self.jsonheader is None:
                 self.process_jsonheader()
 
@@ -185,11 +227,24 @@ class Message:
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
+            for ireq in list(self._shms.keys()):
+                self._release_shm( ireq )
+
+    def _release_shm(self, ireq):
+        if ireq in self._shms:
+            shm = self._shms.pop( ireq )
+            shm.close()
+            shm.unlink()
 
     def queue_request(self):
-        content = self.request['content']
-        content_type = self.request['type']
-        content_encoding = self.request['encoding']
+        for ireq, request in enumerate(self.requests):
+            self._send_buffer += self._create_request(request, ireq)
+        self._request_queued = True
+
+    def _create_request(self, request, ireq=0):
+        content = request['content']
+        content_type = request['type']
+        content_encoding = request['encoding']
         if content_type == 'text/json':
             req = {
                 'content_bytes': self._json_encode(content, content_encoding),
@@ -205,6 +260,15 @@ class Message:
               'content_encoding': content_encoding,
               'arrsize': shapes,
             }
+        elif content_type == 'shm/array':
+            (shmname,shapes) = self._shm_encode(content, ireq)
+            req = {
+              'content_bytes': b'',
+              'content_type': content_type,
+              'content_encoding': content_encoding,
+              'arrsize': shapes,
+              'shmname': shmname,
+            }
         else:
             req = {
                 'content_bytes': content,
@@ -212,9 +276,7 @@ class Message:
                 'content_encoding': content_encoding,
                 'arrsize': None,
             }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
+        return self._create_message(**req)
 
     def process_protoheader(self):
         hdrlen = 10
@@ -222,14 +284,21 @@ class Message:
           self._payload_len = struct.unpack('=i',self._recv_buffer[0:4])[0]
           self._reqid = struct.unpack('=i',self._recv_buffer[4:8])[0]
           self._subid = struct.unpack('=h',self._recv_buffer[8:hdrlen])[0]
-          self._jsonheader_len = struct.unpack('=i',self._recv_buffer[hdrlen:14])[0]
-          self._recv_buffer = self._recv_buffer[hdrlen:]
+          # Preallocate the payload, and move the bytes already received
+          self._payload = memoryview( bytearray(self._payload_len) )
+          nrbytes = min( self._payload_len, len(self._recv_buffer)-hdrlen )
+          self._payload[:nrbytes] = self._recv_buffer[hdrlen:hdrlen+nrbytes]
+          self._payload_pos = nrbytes
+          del self._recv_buffer[:hdrlen+nrbytes]
 
     def process_jsonheader(self):
-        hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            (self.jsonheader,self._recv_buffer) = self._json_decode(
-                self._recv_buffer, "utf-8"
+        if self._payload_pos < 4:
+          return
+        hdrlen = struct.unpack('=i',self._payload[:4])[0]
+        if self._payload_pos >= 4+hdrlen:
+            self._jsonheader_len = hdrlen
+            (self.jsonheader,_) = self._json_decode(
+                self._payload[:4+hdrlen], "utf-8"
             )
             for reqhdr in (
                 "byteorder",
@@ -242,26 +311,38 @@ class Message:
 
     def process_response(self):
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        offset = 4+self._jsonheader_len
+        if self._payload_pos < offset+content_len:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        data = self._payload[offset:offset+content_len]
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
-            (self.response,self._recv_buffer) = self._json_decode(data, encoding)
+            (self.response,_) = self._json_decode(data, encoding)
             self._process_response_json_content()
         elif self.jsonheader["content-type"] == 'binary/array':
             shapes = self.jsonheader['array-shape']
             dtypes = self.jsonheader['content-encoding']
             self.response = self._array_decode(data,shapes,dtypes)
             self._process_response_array_content()
+        elif self.jsonheader["content-type"] == 'shm/array':
+            shapes = self.jsonheader['array-shape']
+            dtypes = self.jsonheader['content-encoding']
+            self.response = self._shm_decode(self.jsonheader['shm-name'],shapes,dtypes)
+            self._process_response_array_content()
         else:
             # Binary or unknown content-type
-            self.response = data
+            self.response = bytes(data)
             log_msg(
                 f'received {self.jsonheader["content-type"]} response from',
                 self.addr,
             )
             self._process_response_binary_content()
-        # Close when response has been processed
-        self.close()
+        self.responses.append( self.response )
+        # The input segment of an answered request is not needed anymore
+        self._release_shm( len(self.responses)-1 )
+        # Close when all responses have been processed
+        if len(self.responses) < len(self.requests):
+            self._reset_response()
+            self._process_recv_buffer()
+        else:
+            self.close()
@@ -7,6 +7,8 @@
 #
 #
 
+import asyncio
+import collections
 import io
 import json
 import numpy as np
@@ -16,6 +18,7 @@ import selectors
 import struct
 import sys
 import traceback as tb
+from numpy.lib.stride_tricks import sliding_window_view
 
 from odpy.common import *
 import dgbpy.keystr as dgbkeys
@@ -25,9 +28,47 @@ from dgbpy import mlapply as dgbmlapply
 from dgbpy import dgbtorch
 from dgbpy import dgbscikit, dgbkeras
 
+# Version of the request protocol: clients of version 2 and above can negotiate
+# a persistent connection with a 'handshake' request, and pipeline their requests.
+protocolversion = 2
+# Size of the reads until the OD header of a request is known: the payload
+# itself is then received directly into a buffer of its final size.
+recvheadersize = 65536
+# Maximum number of buffers given to a single sendmsg call (below IOV_MAX)
+sendmaxbuffers = 512
+# Minimum size in bytes of a request payload: the length of its JSON header
+minpayloadsize = 4
+# Maximum size in bytes of a request payload, larger requests are refused
+maxpayloadsize = 1 << 30
+
 class ExitCommand(Exception):
     pass
 
+class PoolShutdown(Exception):
+    """ Raised in a process of the pre-forked pool when another one stops the server """
+    pass
+
+def getSharedMemory( name=None, size=0 ):
+    """ Attaches to a shared memory segment, or creates one if no name is given.
+
+    The segments are owned by the client, that unlinks them: they are not tracked
+    by this process, to avoid removing them on exit.
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    shm = shared_memory.SharedMemory( name=name, create=name is None, size=max(size,1) )
+    try:
+        resource_tracker.unregister( shm._name, 'shared_memory' )
+    except Exception:
+        pass
+    return shm
+
+def isValidPayloadLength( payload_len, addr ):
+    """ Checks the payload length of an OD header, before its buffer is allocated """
+    if minpayloadsize <= payload_len <= maxpayloadsize:
+        return True
+    log_msg( 'error: invalid payload length', payload_len, 'from', addr, '- closing the connection' )
+    return False
+
 class ModelApplier:
     def __init__(self, modelfnm, applydir=dgbkeys.inlinestr, isfake=False):
         self.pars_ = None
@@ -39,6 +80,7 @@ class ModelApplier:
         self.model_ = None
         self.applyinfo_ = None
         self.batchsize_ = None
+        self.outbuffers_ = {}
         self.debugstr = ''
         self.applydir_ = applydir
 
@@ -75,10 +117,16 @@ class ModelApplier:
         elif self.info_[dgbkeys.plfdictstr] == dgbkeys.torchplfnm:
             if dgbkeys.prefercpustr in outputs:
                 dgbtorch.set_compute_device( outputs[dgbkeys.prefercpustr] )
+        elif self.info_[dgbkeys.plfdictstr] == dgbkeys.scikitplfnm:
+            self._usePar( {key: outputs[key] for key in dgbscikit.onnxthreadkeys if key in outputs} )
+        elif self.info_[dgbkeys.plfdictstr] == dgbkeys.onnxplfnm:
+            import dgbpy.dgbonnx as dgbonnx
+            self._usePar( dgbonnx.getParams(outputs) )
+            self.batchsize_ = self.pars_['batch']
         if self.fakeapply_:
             return None
         modelfnm = self.info_[dgbkeys.filedictstr]
-        (self.model_,self.info_) = dgbmlio.getModel( modelfnm, fortrain=False )
+        (self.model_,self.info_) = dgbmlio.getModel( modelfnm, fortrain=False, pars=self.pars_ )
         self._set_transpose()
 
     def _usePar(self, pars):
@@ -141,7 +189,35 @@ class ModelApplier:
 
         return self.scaler_
 
-    def preprocess(self,samples):
+    def getWindows(self,inp,samples_shape,vertical):
+        """
+            Returns all windows of samples_shape[-1] samples along the last axis of inp,
+            with the windows along the first axis.
+            The windows are a read-only strided view of inp, no data is copied,
+            except for 2D inputs where the view is broadcast over the attributes.
+        """
+        nrz = samples_shape[-1]
+        if vertical:
+            windows = sliding_window_view( inp, nrz, axis=-1 )
+            return np.moveaxis( windows, -2, 0 )[:,:,np.newaxis,np.newaxis,:]
+        if self.is2dinp_:
+            windows = sliding_window_view( inp[-1], nrz, axis=-1 )
+            windows = np.moveaxis( windows, -2, 0 )[:,np.newaxis,np.newaxis]
+            return np.array( np.broadcast_to(windows, samples_shape) )
+        windows = sliding_window_view( inp, nrz, axis=-1 )
+        return np.moveaxis( windows, -2, 0 )
+
+    def scaleWindows(self,samples,inp,samples_shape,vertical):
+        """
+            Applies the scaler to the input trace(s) instead of their windows,
+            which is equivalent since all scalings are applied per attribute and sample value.
+        """
+        if samples.flags.writeable:
+            return dgbscikit.scale( samples, self.scaler_ )
+        src = dgbscikit.scale( inp[np.newaxis].copy(), self.scaler_ )
+        return self.getWindows( src[0], samples_shape, vertical )
+
+    def preprocess(self,samples,inp=None,samples_shape=None,vertical=False):
         if dgbhdf5.applyLocalStd( self.info_ ):
             self.scaler_ = dgbscikit.getScaler( samples, True )
         elif dgbhdf5.applyNormalization( self.info_ ):
@@ -156,7 +232,10 @@ class ModelApplier:
                 raise TypeError
 
         if self.scaler_ != None:
-            samples = dgbscikit.scale( samples, self.scaler_ )
+            if inp is None:
+                samples = dgbscikit.scale( samples, self.scaler_ )
+            else:
+                samples = self.scaleWindows( samples, inp, samples_shape, vertical )
 
         if self.needtranspose_:
             samples = np.transpose( samples, axes=(0,1,4,3,2) )
@@ -194,6 +273,18 @@ class ModelApplier:
         return outdata
 
     def doWork(self,inp):
+        (samples,inp,samples_shape) = self.prepareWork( inp )
+        if self.isFlatApply():
+            ret = self.flatApply( inp, samples, samples_shape )
+        else:
+            ret = self.applySamples( samples )
+        return self.finishWork( ret )
+
+    def prepareWork(self,inp):
+        """
+            Builds the preprocessed model input samples of a block of traces.
+            The state needed by finishWork is kept in the applier, see getState.
+        """
         nrattribs = inp.shape[0]
         inpshape = self.info_[dgbkeys.inpshapedictstr]
         nrzin = inp.shape[-1]
@@ -219,57 +310,78 @@ class ModelApplier:
             nrzoutsamps = nrzin - inpshape[2] +1
         samples_shape = dgbhdf5.get_np_shape( inpshape, nrattribs=nrattribs,
                                               nrpts=nrzoutsamps )
-        nrtrcs = samples_shape[-2]
         nrz = samples_shape[-1]
-        allsamples = list()
+        windowed = nrz > 1 and not self.swapaxes_
         if nrz == 1:
             inp = np.transpose( inp )
-            allsamples.append( np.resize( np.array(inp), samples_shape ) )
+            samples = np.resize( np.array(inp), samples_shape )
         else:
-            loc_samples = np.empty( samples_shape, dtype=inp.dtype )
-            if (self.isflat_inlinemodel_ or self.isflat_xlinemodel_) and not self.is2dinp_:
-                loc_samples = np.empty((1,)+inp.shape, dtype=inp.dtype)
-
-            if vertical:
-                for zidz in range(nrzoutsamps):
-                    loc_samples[zidz,:,0,0,:] = inp[:,zidz:zidz+nrz]
-                allsamples.append( loc_samples )
-            elif self.is2dinp_:
-                for ich in range(inp.shape[0]):
-                    for zidz in range(nrzoutsamps):
-                        loc_samples[zidz] = inp[ich,:,zidz:zidz+nrz]
-                allsamples.append( loc_samples )
-            else :
-                for zidz in range(nrzoutsamps):
-                    loc_samples[zidz] = inp[:,:,:,zidz:zidz+nrz]
-                allsamples.append( loc_samples )
+            samples = self.getWindows( inp, samples_shape, vertical )
 
-        samples = np.concatenate(allsamples)
         if self.swapaxes_:
             samples = samples.swapaxes(*self._get_swapaxes_dim(samples))
 
-        samples = self.preprocess( samples )
+        if windowed:
+            samples = self.preprocess( samples, inp, samples_shape, vertical )
+        else:
+            samples = self.preprocess( np.ascontiguousarray(samples) )
+
+        return (samples,inp,samples_shape)
 
-        ret = {}
-        if self.info_[dgbkeys.learntypedictstr] == dgbkeys.seisimgtoimgtypestr and not self.is2dinp_ and \
+    def isFlatApply(self):
+        return self.info_[dgbkeys.learntypedictstr] == dgbkeys.seisimgtoimgtypestr and not self.is2dinp_ and \
             (self.isflat_inlinemodel_ or self.isflat_xlinemodel_) and \
-            self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]:
-            ret[dgbkeys.preddictstr] = self.flatModelApply(inp, samples, samples_shape)
-            if self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]:
-                samples = samples.swapaxes(*self._get_swapaxes_dim(samples))
-                newret = self.flatModelApply(inp, samples, samples_shape)
-                newret = newret.swapaxes(*self._get_swapaxes_dim(samples))
-                if self.applydir_ == dgbkeys.averagestr:
-                    ret[dgbkeys.preddictstr] = (newret + ret[dgbkeys.preddictstr])/2
-                elif self.applydir_ == dgbkeys.minstr:
-                    ret[dgbkeys.preddictstr] = np.minimum(newret, ret[dgbkeys.preddictstr])
-                else :
-                    ret[dgbkeys.preddictstr] = np.maximum(newret, ret[dgbkeys.preddictstr])
-        else:
-            ret = dgbmlapply.doApply( self.model_, self.info_, samples, \
-                                      scaler=None, applyinfo=self.applyinfo_, \
-                                      batchsize=self.batchsize_ )
+            self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]
+
+    def flatApply(self,inp,samples,samples_shape):
+        ret = {}
+        ret[dgbkeys.preddictstr] = self.flatModelApply(inp, samples, samples_shape)
+        if self.applydir_ in [dgbkeys.averagestr, dgbkeys.minstr, dgbkeys.maxstr]:
+            samples = samples.swapaxes(*self._get_swapaxes_dim(samples))
+            newret = self.flatModelApply(inp, samples, samples_shape)
+            newret = newret.swapaxes(*self._get_swapaxes_dim(samples))
+            if self.applydir_ == dgbkeys.averagestr:
+                ret[dgbkeys.preddictstr] = (newret + ret[dgbkeys.preddictstr])/2
+            elif self.applydir_ == dgbkeys.minstr:
+                ret[dgbkeys.preddictstr] = np.minimum(newret, ret[dgbkeys.preddictstr])
+            else :
+                ret[dgbkeys.preddictstr] = np.maximum(newret, ret[dgbkeys.preddictstr])
+        return ret
+
+    def applySamples(self,samples):
+        return dgbmlapply.doApply( self.model_, self.info_, samples, \
+                                   scaler=None, applyinfo=self.applyinfo_, \
+                                   batchsize=self.batchsize_, outbuffers=self.outbuffers_ )
+
+    def getSamplesAxis(self, key, arr):
+        """
+            Axis of the samples in the key output of applySamples: the outputs of image
+            to image models, and the regression predictions of the platforms returning
+            the model output as is, are samples first. The other outputs have one row
+            per output (class or probability), and the samples along the last axis.
+        """
+        if arr.ndim < 2 or dgbhdf5.isImg2Img( self.info_ ):
+            return 0
+        if key != dgbkeys.preddictstr or self.info_[dgbkeys.classdictstr]:
+            return -1
+        platform = self.info_[dgbkeys.plfdictstr]
+        if dgbhdf5.isZipModel( self.info_ ) or \
+           platform in (dgbkeys.torchplfnm, dgbkeys.onnxplfnm, dgbkeys.numpyvalstr):
+            return 0
+        if platform == dgbkeys.kerasplfnm and len(self.model_.output_shape) > 2:
+            return 0
+        return -1
+
+    def getState(self):
+        """
+            State of the last prepareWork call, used by finishWork
+        """
+        return (self.is2dinp_, self.swapaxes_, self.scaler_)
+
+    def setState(self,state):
+        (self.is2dinp_, self.swapaxes_, self.scaler_) = state
 
+    def finishWork(self,ret):
         if dgbkeys.preddictstr in ret:
             ret[dgbkeys.preddictstr] = self.postprocess( ret[dgbkeys.preddictstr] )
     
@@ -307,13 +419,127 @@ class ModelApplier:
         return self.debugstr
 
 
+class BatchScheduler:
+    """
+        Coalesces the apply requests of concurrent connections into larger model batches.
+        The samples of the pending requests are applied together once maxsamples samples
+        are pending, or when the oldest request has waited maxdelay seconds.
+        The predictions are then split back per request.
+    """
+    def __init__(self, applier, maxsamples, maxdelay=0.005):
+        self.applier = applier
+        self.maxsamples = maxsamples
+        self.maxdelay = maxdelay
+        self.pending = list()
+        self.nrsamples = 0
+        self.start = None
+
+    def add(self, message):
+        """
+            Prepares the samples of an apply request, and queues the request.
+            The message is resumed once its result is available.
+        """
+        import time
+        try:
+            for arr in message.request.get('data'):
+                (samples,inp,samples_shape) = self.applier.prepareWork( arr )
+                if self.applier.isFlatApply():
+                    ret = self.applier.flatApply( inp, samples, samples_shape )
+                    message.result = self.applier.finishWork( ret )
+                    continue
+                self.pending.append( (message, samples, self.applier.getState()) )
+                self.nrsamples += len(samples)
+        except Exception as e:
+            message.result = e
+            self.pending = [entry for entry in self.pending if entry[0] is not message]
+            self.nrsamples = sum([len(entry[1]) for entry in self.pending])
+        if not any([entry[0] is message for entry in self.pending]):
+            message.resume()
+        elif self.start == None:
+            self.start = time.monotonic()
+
+    def timeout(self):
+        import time
+        if self.start == None:
+            return None
+        return max(0, self.start + self.maxdelay - time.monotonic())
+
+    def ready(self):
+        return len(self.pending) > 0 and \
+               (self.nrsamples >= self.maxsamples or self.timeout() == 0)
+
+    def flush(self):
+        """
+            Applies the pending samples in batches of identical sample shapes
+        """
+        pending = self.pending
+        self.pending = list()
+        self.nrsamples = 0
+        self.start = None
+        groups = {}
+        for entry in pending:
+            samples = entry[1]
+            groups.setdefault( (samples.shape[1:], samples.dtype.str), list() ).append( entry )
+        for entries in groups.values():
+            self._apply( entries )
+        for message in dict.fromkeys([entry[0] for entry in pending]):
+            message.resume()
+
+    def _apply(self, entries):
+        outs = None
+        if len(entries) > 1:
+            try:
+                samples = np.concatenate( [entry[1] for entry in entries] )
+                ret = self.applier.applySamples( samples )
+                outs = self._split( ret, [len(entry[1]) for entry in entries] )
+            except Exception:
+                outs = None
+        for idx, (message, samples, state) in enumerate(entries):
+            try:
+                ret = outs[idx] if outs else self.applier.applySamples( samples )
+                self.applier.setState( state )
+                message.result = self.applier.finishWork( ret )
+            except Exception as e:
+                message.result = e
+
+    def _split(self, ret, sizes):
+        """
+            Splits each output along its samples axis, as given by the applier
+            (the first or the last one)
+        """
+        nrsamples = sum(sizes)
+        bounds = np.cumsum( sizes )[:-1]
+        outs = [dict() for size in sizes]
+        for key, arr in ret.items():
+            axis = self.applier.getSamplesAxis( key, arr )
+            if arr.shape[axis] != nrsamples:
+                # Output layout not covered by the applier, e.g. a single output row
+                axis = -1 if axis == 0 else 0
+            if arr.shape[axis] != nrsamples:
+                raise ValueError( f'Cannot find the samples axis of the {key} output' )
+            for out, part in zip(outs, np.split(arr, bounds, axis=axis)):
+                out[key] = part
+        return outs
+
+
 class Message:
-    def __init__(self, selector, sock, addr, applier):
+    def __init__(self, selector, sock, addr, applier, keepalive=False, sharedmem=False, scheduler=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = bytearray()
+        self._send_buffers = list()
+        self._shms = list()
+        self._reset_request()
+        self.applier = applier
+        self.lastmessage = False
+        self.keepalive = keepalive
+        self.sharedmem = sharedmem
+        self.scheduler = scheduler
+        self.persistent = False
+        self.protocol = 1
+
+    def _reset_request(self):
         self._payload_len = None
         self._reqid = None
         self._subid = None
@@ -321,8 +547,19 @@ class Message:
         self.jsonheader = None
         self.request = None
         self.response_created = False
-        self.applier = applier
-        self.lastmessage = False
+        self._payload = None
+        self._payload_pos = 0
+        self.result = None
+        self._release_shared_memory()
+
+    def _release_shared_memory(self):
+        for shm in self._shms:
+            try:
+                shm.close()
+            except BufferError:
+                # Still referenced, closed when garbage collected
+                pass
+        self._shms = list()
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -339,29 +576,64 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(16777216)
+            if self._payload is None:
+                data = self.sock.recv(recvheadersize)
+                self._recv_buffer += data
+            else:
+                # Payload size is known: receive in place, without any copy
+                data = self.sock.recv_into(self._payload[self._payload_pos:])
+                self._payload_pos += data
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
             if data:
-                self._recv_buffer += data
+                return
+            if self.persistent and self._payload_len is None and not self._recv_buffer:
+                # The client ended the persistent connection between two requests
+                self.close()
             else:
                 raise RuntimeError("Peer closed.")
 
+    def _send(self):
+        # Scatter-gather write of the queued buffers, without joining them
+        if hasattr(self.sock, 'sendmsg'):
+            return self.sock.sendmsg(self._send_buffers[:sendmaxbuffers])
+        return self.sock.send(self._send_buffers[0])
+
+    def _consume(self, sent):
+        # Drops the bytes sent from the queue, by slicing the memoryviews
+        while sent > 0 and self._send_buffers:
+            buf = self._send_buffers[0]
+            if sent < len(buf):
+                self._send_buffers[0] = buf[sent:]
+                return
+            sent -= len(buf)
+            self._send_buffers.pop(0)
+
     def _write(self):
-        if self._send_buffer:
+        if self._send_buffers:
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                sent = self._send()
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                self._consume(sent)
                 # Close when the buffer is drained. The response has been sent.
-                if sent and not self._send_buffer:
-                    self.close()
+                # Persistent connections wait for the next request instead.
+                if sent and not self._send_buffers:
+                    if self.persistent and not self.lastmessage:
+                        self._next_request()
+                    else:
+                        self.close()
+
+    def _next_request(self):
+        self._reset_request()
+        self._set_selector_events_mask("r")
+        # Pipelined requests may already be buffered
+        self._process_recv_buffer()
 
     def _json_encode(self, obj, encoding):
         json_hdr = json.dumps(obj, ensure_ascii=False).encode(encoding)
@@ -391,24 +663,45 @@ class Message:
           'data': arrs
         }
 
+    def _shm_decode(self, shmname, shapes, dtypes):
+        shm = getSharedMemory( shmname )
+        self._shms.append( shm )
+        return self._array_decode( shm.buf, shapes, dtypes )
+
+    def _shm_encode(self, arrs):
+        shm = getSharedMemory( size=sum([arr.nbytes for arr in arrs]) )
+        self._shms.append( shm )
+        offset = 0
+        for arr in arrs:
+          np.ndarray( arr.shape, dtype=arr.dtype, buffer=shm.buf, offset=offset )[...] = arr
+          offset += arr.nbytes
+        return shm.name
+
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding, arrsize
+        self, *, content_bytes, content_type, content_encoding, arrsize, shmname=None
     ):
+        # The content is a buffer or a list of buffers, that are sent as is
+        if not isinstance(content_bytes, list):
+            content_bytes = [content_bytes]
+        contents = [memoryview(content).cast('B') for content in content_bytes]
+        contents = [content for content in contents if content.nbytes > 0]
+        content_len = sum([content.nbytes for content in contents])
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
+            "content-length": content_len,
         }
         if arrsize != None:
           jsonheader.update({ 'array-shape': arrsize })
+        if shmname != None:
+          jsonheader.update({ 'shm-name': shmname })
         (self,jsonheader) = self._add_debug_str( jsonheader )
         jsonheader_bytes = self._json_encode(jsonheader, 'utf-8')
-        payload = jsonheader_bytes + content_bytes
-        od_hdr =   struct.pack('=i',len(payload)) \
+        od_hdr =   struct.pack('=i',len(jsonheader_bytes)+content_len) \
                  + struct.pack('=i',self._reqid) \
                  + struct.pack('=h',self._subid)
-        return od_hdr + payload
+        return [memoryview(od_hdr + jsonheader_bytes)] + contents
 
     def _make_exception_report(self, msg, exc):
         exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -416,10 +709,24 @@ class Message:
         stackstr = ''.join(tb.extract_tb(exc_tb,limit=10).format())
         return f'{msg}:\n{repr(exc)} on line {str(exc_tb.tb_lineno)} of script {fname}\n{stackstr}\n\n{self.applier.debugstr}'
 
+    def _handshake(self, value):
+        if not isinstance(value, dict):
+            value = {}
+        self.protocol = max(1, min(int(value.get('protocol', 1)), protocolversion))
+        self.persistent = self.keepalive and self.protocol > 1 and \
+                          value.get('keepalive', True)
+        return {
+            'result': 'Handshake accepted',
+            'protocol': self.protocol,
+            'keepalive': self.persistent,
+        }
+
     def _create_response_json_content(self):
         action = self.request.get('action')
         content = { 'result': None }
-        if action == 'status':
+        if action == 'handshake':
+            content = self._handshake( self.request.get('value') )
+        elif action == 'status':
             content['result'] = 'Server online'
             content['pid'] = psutil.Process().pid
         elif action == 'kill':
@@ -446,7 +753,12 @@ class Message:
         action = self.request.get('action')
         try:
             res = list()
-            if action == 'apply':
+            if action == 'apply' and self.result != None:
+                # Computed by the batch scheduler
+                if isinstance(self.result, Exception):
+                    raise self.result
+                res = self.result
+            elif action == 'apply':
                 for arr in self.request.get('data'):
                     res = self.applier.doWork(arr)
             else:
@@ -463,15 +775,23 @@ class Message:
             }
             return (self,response)
 
-        ret = bytes()
         dtypes = list()
         shapes = list()
         for arr in res:
-          ret += arr.tobytes()
           shapes.append( arr.shape )
           dtypes.append( arr.dtype.name )
+        if self.jsonheader['content-type'] == 'shm/array':
+          # The outputs are written in a new segment, only its name is sent
+          response = {
+            'content_bytes': b'',
+            'content_type': 'shm/array',
+            'content_encoding': dtypes,
+            'arrsize': shapes,
+            'shmname': self._shm_encode( res ),
+          }
+          return (self,response)
         response = {
-          'content_bytes': ret,
+          'content_bytes': [np.ascontiguousarray(arr) for arr in res],
           'content_type': "binary/array",
           'content_encoding': dtypes,
           'arrsize': shapes,
@@ -505,7 +825,10 @@ class Message:
 
     def read(self):
         self._read()
+        if self.sock:
+            self._process_recv_buffer()
 
+    def _process_recv_buffer(self):
         if self._payload_len is None:
             self.process_odheader()
 
@@ -543,20 +866,37 @@ class Message:
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
+            self.request = None
+            self._release_shared_memory()
 
     def process_odheader(self):
         hdrlen = 10
         if len(self._recv_buffer) >= hdrlen:
-            self._payload_len = struct.unpack('=i',self._recv_buffer[0:4])[0]
+            payload_len = struct.unpack('=i',self._recv_buffer[0:4])[0]
+            if not isValidPayloadLength( payload_len, self.addr ):
+                self.close()
+                return
+            self._payload_len = payload_len
             self._reqid = struct.unpack('=i',self._recv_buffer[4:8])[0]
             self._subid = struct.unpack('=h',self._recv_buffer[8:hdrlen])[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            # Preallocate the payload, and move the bytes already received
+            # Bytes beyond the payload belong to the next pipelined request
+            self._payload = memoryview( bytearray(self._payload_len) )
+            nrbytes = min( self._payload_len, len(self._recv_buffer)-hdrlen )
+            self._payload[:nrbytes] = self._recv_buffer[hdrlen:hdrlen+nrbytes]
+            self._payload_pos = nrbytes
+            del self._recv_buffer[:hdrlen+nrbytes]
 
     def process_jsonheader(self):
-        if len(self._recv_buffer) >= 4:
-            (self._jsonheader_len,self.jsonheader,self._recv_buffer) = \
+        if self._payload_pos < 4:
+            return
+        hdrlen = struct.unpack('=i',self._payload[:4])[0]
+        if hdrlen < 0 or 4+hdrlen > len(self._payload):
+            raise ValueError(f'Invalid JSON header length {hdrlen}.')
+        if self._payload_pos >= 4+hdrlen:
+            (self._jsonheader_len,self.jsonheader,_) = \
                 self._json_decode(
-                    self._recv_buffer, "utf-8"
+                    self._payload[:4+hdrlen], "utf-8"
             )
             for reqhdr in (
                 "byteorder",
@@ -569,36 +909,241 @@ class Message:
 
     def process_request(self):
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+        offset = 4+self._jsonheader_len
+        if self._payload_pos < offset+content_len:
+            return
+        self.decode_request( self._payload[offset:offset+content_len] )
+        if self.scheduler and isinstance(self.request, dict) and \
+           self.request.get('action') == 'apply':
+            # Wait for the batch result without polling the socket
+            self.selector.unregister(self.sock)
+            self.scheduler.add(self)
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        # Set selector to listen for write events, we're done reading.
+        self._set_selector_events_mask("w")
+
+    def decode_request(self, data):
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
-            (jsonsz,self.request,self._recv_buffer) = \
-                                 self._json_decode(data, encoding)
+            (jsonsz,self.request,_) = self._json_decode(data, encoding)
         elif self.jsonheader["content-type"] == 'binary/array':
             shapes = self.jsonheader['array-shape']
             dtypes = self.jsonheader['content-encoding']
             self.request = self._array_decode(data,shapes,dtypes)
+        elif self.jsonheader["content-type"] == 'shm/array':
+            if not self.sharedmem:
+                raise ValueError('Shared memory requests require a local server.')
+            shapes = self.jsonheader['array-shape']
+            dtypes = self.jsonheader['content-encoding']
+            self.request = self._shm_decode(self.jsonheader['shm-name'],shapes,dtypes)
         else:
             # Binary or unknown content-type
-            self.request = data
+            self.request = bytes(data)
             print(
                 f'received {self.jsonheader["content-type"]} request from',
                 self.addr,
             )
-        # Set selector to listen for write events, we're done reading.
-        self._set_selector_events_mask("w")
+
+    def resume(self):
+        if self.sock:
+            self.selector.register(self.sock, selectors.EVENT_WRITE, data=self)
 
     def create_response(self):
         if self.jsonheader["content-type"] == 'text/json':
             response = self._create_response_json_content()
-        elif self.jsonheader["content-type"] == 'binary/array':
+        elif self.jsonheader["content-type"] in ('binary/array', 'shm/array'):
             (self,response) = self._create_response_array_content()
         else:
             # Binary or unknown content-type
             response = self._create_response_binary_content()
         message = self._create_message(**response)
         self.response_created = True
-        self._send_buffer += message
+        self._send_buffers.extend( message )
+
+
+class ApplyProtocol(asyncio.BufferedProtocol):
+    """
+        Connection of the asyncio apply server, with the same wire protocol as Message.
+        Each request is received in place into a buffer of its payload size, and is
+        answered by a new Message. The requests using the model are processed on the
+        executor of the server, while the next request of the connection is received.
+        The responses are sent in the order of the requests.
+    """
+    hdrlen = 10
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.persistent = False
+        self.protocol = 1
+        self.responses = collections.deque()
+        self.paused = False
+        self.closing = False
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self._header = bytearray(self.hdrlen)
+        self._payload = None
+        self._buffer = memoryview(self._header)
+        self._pos = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+
+    def connection_lost(self, exc):
+        self.closing = True
+        self.server.release(self)
+
+    def get_buffer(self, sizehint):
+        return self._buffer[self._pos:]
+
+    def buffer_updated(self, nbytes):
+        self._pos += nbytes
+        if self._pos < len(self._buffer):
+            return
+        if self._payload is None:
+            payload_len = struct.unpack('=i',self._header[0:4])[0]
+            if not isValidPayloadLength( payload_len, self.addr ):
+                self.transport.close()
+                return
+            self._payload = memoryview( bytearray(payload_len) )
+            self._buffer = self._payload
+            self._pos = 0
+            if payload_len > 0:
+                return
+        try:
+            self._dispatch()
+        except Exception:
+            log_msg( 'error: invalid request from', self.addr, f':\n{tb.format_exc()}' )
+            self.transport.close()
+
+    def eof_received(self):
+        return False
+
+    def _new_message(self):
+        message = Message(None, None, self.addr, self.server.applier,
+                          keepalive=self.server.keepalive, sharedmem=self.server.sharedmem)
+        message._reqid = struct.unpack('=i',self._header[4:8])[0]
+        message._subid = struct.unpack('=h',self._header[8:self.hdrlen])[0]
+        message.persistent = self.persistent
+        message.protocol = self.protocol
+        message._payload = self._payload
+        message._payload_len = message._payload_pos = len(self._payload)
+        return message
+
+    def _dispatch(self):
+        message = self._new_message()
+        self._reset_buffer()
+        message.process_jsonheader()
+        offset = 4+message._jsonheader_len
+        message.decode_request( message._payload[offset:offset+message.jsonheader['content-length']] )
+        if self.server.usesModel( message ):
+            future = self.server.submit( message.create_response )
+        else:
+            message.create_response()
+            self.persistent = message.persistent
+            self.protocol = message.protocol
+            future = asyncio.get_running_loop().create_future()
+            future.set_result( None )
+        self.responses.append( (message, future) )
+        future.add_done_callback( lambda fut: self._send_responses() )
+        if not self.persistent:
+            # Without handshake, a single request is received per connection
+            self.transport.pause_reading()
+            self.paused = True
+        self.server.acquire( self )
+
+    def _send_responses(self):
+        while self.responses and self.responses[0][1].done():
+            (message, future) = self.responses.popleft()
+            self.server.release( self )
+            if self.closing:
+                message._reset_request()
+                continue
+            if future.exception() != None:
+                log_msg( 'error: apply exception for', self.addr, repr(future.exception()) )
+                self.transport.close()
+                continue
+            self.transport.writelines( message._send_buffers )
+            message._send_buffers = list()
+            message._reset_request()
+            if message.lastmessage:
+                self.server.stop()
+            if message.lastmessage or not self.persistent:
+                self.transport.close()
+                self.closing = True
+
+    def pause(self):
+        if not self.paused and not self.closing:
+            self.transport.pause_reading()
+            self.paused = True
+
+    def resume(self):
+        if self.paused and self.persistent and not self.closing:
+            self.transport.resume_reading()
+            self.paused = False
+
+
+class AsyncApplyServer:
+    """
+        asyncio apply server: the network I/O runs on the event loop, while the model
+        is applied on a single worker thread, in the order of the requests.
+        At most maxpending requests are received ahead of their response: reading
+        is paused on all connections until some are answered (back-pressure).
+    """
+    def __init__(self, applier, keepalive=False, sharedmem=False, maxpending=4):
+        from concurrent.futures import ThreadPoolExecutor
+        self.applier = applier
+        self.keepalive = keepalive
+        self.sharedmem = sharedmem
+        self.maxpending = maxpending
+        self.executor = ThreadPoolExecutor( max_workers=1 )
+        self.connections = set()
+        self.nrpending = 0
+        self.stopped = None
+
+    def usesModel(self, message):
+        if message.jsonheader['content-type'] != 'text/json':
+            return True
+        return message.request.get('action') not in ('handshake', 'status', 'kill')
+
+    def submit(self, fn):
+        return asyncio.get_running_loop().run_in_executor( self.executor, fn )
+
+    def acquire(self, conn):
+        self.connections.add( conn )
+        self.nrpending += 1
+        if self.nrpending >= self.maxpending:
+            for conn in self.connections:
+                conn.pause()
+
+    def release(self, conn):
+        if conn.closing and not conn.responses:
+            self.connections.discard( conn )
+        self.nrpending = sum([len(conn.responses) for conn in self.connections])
+        if self.nrpending < self.maxpending:
+            for conn in self.connections:
+                conn.resume()
+
+    def stop(self):
+        if self.stopped != None:
+            self.stopped.set()
+
+    async def serve(self, lsock, local=False):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        lsock.setblocking(False)
+        if local:
+            server = await loop.create_unix_server( lambda: ApplyProtocol(self), sock=lsock )
+        else:
+            server = await loop.create_server( lambda: ApplyProtocol(self), sock=lsock )
+        async with server:
+            await self.stopped.wait()
+        self.executor.shutdown( wait=True )
+
+def serveAsync(lsock, applier, local=False, keepalive=False, maxpending=4):
+    """ Runs the asyncio apply server on an already listening socket, until a 'kill' request """
+    server = AsyncApplyServer( applier, keepalive=keepalive, sharedmem=local, maxpending=maxpending )
+    asyncio.run( server.serve(lsock, local) )
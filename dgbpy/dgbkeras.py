@@ -31,7 +31,8 @@ try:
   from keras.callbacks import Callback
 except ModuleNotFoundError:
   pass
-from dgbpy.mlio import announceShowTensorboard, announceTrainingFailure, announceTrainingSuccess, saveModel, getStoredParams
+from dgbpy.mlio import announceShowTensorboard, announceTrainingFailure, announceTrainingSuccess, saveModel, getStoredParams, \
+                       getApplyResults
 
 def hasKeras():
   try:
@@ -92,7 +93,8 @@ keras_dict = {
   'tofp16': False,
   'userandomseed': 42,
   'stopaftercurrentepoch': False,
-  'summary': None
+  'summary': None,
+  'prefetch': False
 }
 
 settings_mltrain_path = get_settings_filename('settings_mltrain.json')
@@ -146,7 +148,7 @@ def getParams( dodec=keras_dict[dgbkeys.decimkeystr], nbchunk=keras_dict['nbchun
                validation_split=keras_dict['split'], nbfold=keras_dict['nbfold'], savetype = keras_dict['savetype'],
                scale = keras_dict['scale'],withtensorboard=keras_dict['withtensorboard'], tblogdir=keras_dict['tblogdir'],
                tofp16=keras_dict['tofp16'], userandomseed=keras_dict['userandomseed'], stopaftercurrentepoch=keras_dict['stopaftercurrentepoch'],
-               summary=keras_dict['summary']):
+               summary=keras_dict['summary'], prefetch=keras_dict['prefetch']):
   ret = {
     dgbkeys.decimkeystr: dodec,
     'nbchunk': nbchunk,
@@ -166,7 +168,8 @@ def getParams( dodec=keras_dict[dgbkeys.decimkeystr], nbchunk=keras_dict['nbchun
     'tofp16': tofp16,
     'userandomseed':userandomseed,
     'stopaftercurrentepoch': stopaftercurrentepoch,
-    'summary': summary
+    'summary': summary,
+    'prefetch': prefetch
   }
   if prefercpu == None:
     prefercpu = get_cpu_preference()
@@ -544,65 +547,74 @@ def train(model,training,params=keras_dict,trainfile=None,silent=False,cbfn=None
                                     outfnm=outfnm, tmpsavedict=tmp_save_dict )
   validate_datagen = TrainingSequence( training, True, model, exfilenm=trainfile, batch_size=batchsize, scale=scale )
   nbchunks = len( infos[dgbkeys.trainseldicstr] )
+  prefetcher = None
+  if params.get('prefetch',False) and (nbchunks > 1 or dgbhdf5.isCrossValidation(infos)):
+    from dgbpy.mlapply import ChunkPrefetcher
+    prefetcher = ChunkPrefetcher( infos, scale=train_datagen.isDefScaler )
+    train_datagen.prefetcher = prefetcher
+    validate_datagen.prefetcher = prefetcher
 
-  for ichunk in range(nbchunks):
-    log_msg('Starting training iteration',str(ichunk+1)+'/'+str(nbchunks))
-    try:
-      if not train_datagen.set_chunk(ichunk) or not validate_datagen.set_chunk(ichunk):
-        continue
-    except Exception as e:
-      log_msg('')
-      log_msg('Data loading failed because of insufficient memory')
-      log_msg('Try to lower the batch size and restart the training')
-      log_msg('')
-      announceTrainingFailure()
-      raise e
-    if  len(train_datagen) < 1 or len(validate_datagen) < 1:
-      log_msg('')
-      log_msg('There is not enough data to train on')
-      log_msg('Extract more data and restart')
-      log_msg('')
-      announceTrainingFailure()
-      raise TypeError
-    redirect_stdout()
-    isCrossVal = dgbhdf5.isCrossValidation(infos)
-    config = { 'train_datagen':train_datagen, 'valid_datagen':validate_datagen,
-                'ichunk':ichunk+1, 'nbchunks':nbchunks,'isCrossVal':isCrossVal, 'batchsize':batchsize }
-    try:
-      if not isCrossVal:
-        callbacks = init_callbacks(monitor, params,logdir,silent,config,cbfn=cbfn)
-        if params['stopaftercurrentepoch']:
-          callbacks.append(StopTrainingCallback(params['stopaftercurrentepoch']))
-        progress_callback = next((callback for callback in callbacks if isinstance(callback, ProgressNoBarCallback)), None)
-        if progress_callback:
-          callbacks.append(SaveTrainingSummaryCallback(progress_callback))
-        model.fit(x=train_datagen,epochs=params['epochs'],verbose=0,
-                            validation_data=validate_datagen,callbacks=callbacks)
-      else:
-        nbfolds = len(infos[dgbkeys.trainseldicstr][ichunk])
-        for ifold in range(1, nbfolds+1):
-          train_datagen.set_fold(ichunk, ifold)
-          validate_datagen.set_fold(ichunk, ifold)
-          config['ifold'], config['nbfolds'] = ifold, nbfolds
-          callbacks = init_callbacks(monitor,params,logdir,silent,config,cbfn=cbfn)
+  try:
+    for ichunk in range(nbchunks):
+      log_msg('Starting training iteration',str(ichunk+1)+'/'+str(nbchunks))
+      try:
+        if not train_datagen.set_chunk(ichunk) or not validate_datagen.set_chunk(ichunk):
+          continue
+      except Exception as e:
+        log_msg('')
+        log_msg('Data loading failed because of insufficient memory')
+        log_msg('Try to lower the batch size and restart the training')
+        log_msg('')
+        announceTrainingFailure()
+        raise e
+      if  len(train_datagen) < 1 or len(validate_datagen) < 1:
+        log_msg('')
+        log_msg('There is not enough data to train on')
+        log_msg('Extract more data and restart')
+        log_msg('')
+        announceTrainingFailure()
+        raise TypeError
+      redirect_stdout()
+      isCrossVal = dgbhdf5.isCrossValidation(infos)
+      config = { 'train_datagen':train_datagen, 'valid_datagen':validate_datagen,
+                  'ichunk':ichunk+1, 'nbchunks':nbchunks,'isCrossVal':isCrossVal, 'batchsize':batchsize }
+      try:
+        if not isCrossVal:
+          callbacks = init_callbacks(monitor, params,logdir,silent,config,cbfn=cbfn)
           if params['stopaftercurrentepoch']:
             callbacks.append(StopTrainingCallback(params['stopaftercurrentepoch']))
           progress_callback = next((callback for callback in callbacks if isinstance(callback, ProgressNoBarCallback)), None)
           if progress_callback:
             callbacks.append(SaveTrainingSummaryCallback(progress_callback))
-          if ifold != 1: # start transfer from second fold
-            transfer(model)
-          model.fit(x=train_datagen,epochs=params['epochs'],verbose=0,validation_data=validate_datagen,callbacks=callbacks)
-    except Exception as e:
-      log_msg('')
-      log_msg('Training failed because of insufficient memory')
-      log_msg('Try to lower the batch size and restart the training')
-      log_msg('')
-      announceTrainingFailure()
-      raise e
-
-    restore_stdout()
+          model.fit(x=train_datagen,epochs=params['epochs'],verbose=0,
+                              validation_data=validate_datagen,callbacks=callbacks)
+        else:
+          nbfolds = len(infos[dgbkeys.trainseldicstr][ichunk])
+          for ifold in range(1, nbfolds+1):
+            train_datagen.set_fold(ichunk, ifold)
+            validate_datagen.set_fold(ichunk, ifold)
+            config['ifold'], config['nbfolds'] = ifold, nbfolds
+            callbacks = init_callbacks(monitor,params,logdir,silent,config,cbfn=cbfn)
+            if params['stopaftercurrentepoch']:
+              callbacks.append(StopTrainingCallback(params['stopaftercurrentepoch']))
+            progress_callback = next((callback for callback in callbacks if isinstance(callback, ProgressNoBarCallback)), None)
+            if progress_callback:
+              callbacks.append(SaveTrainingSummaryCallback(progress_callback))
+            if ifold != 1: # start transfer from second fold
+              transfer(model)
+            model.fit(x=train_datagen,epochs=params['epochs'],verbose=0,validation_data=validate_datagen,callbacks=callbacks)
+      except Exception as e:
+        log_msg('')
+        log_msg('Training failed because of insufficient memory')
+        log_msg('Try to lower the batch size and restart the training')
+        log_msg('')
+        announceTrainingFailure()
+        raise e
 
+      restore_stdout()
+  finally:
+    if prefetcher:
+      prefetcher.close()
   try:
     keras.utils.print_summary( model, print_fn=log_msg )
   except:
@@ -759,7 +771,7 @@ def transfer( model ):
   return model
 
 def apply( model, info, samples, isclassification, withpred, withprobs, \
-           withconfidence, doprobabilities, dictinpshape=None, scaler=None, batch_size=None ):
+           withconfidence, doprobabilities, dictinpshape=None, scaler=None, batch_size=None, out=None ):
   if batch_size == None:
     batch_size = keras_dict['batch']
   redirect_stdout()
@@ -785,50 +797,17 @@ def apply( model, info, samples, isclassification, withpred, withprobs, \
     else:
       nroutputs = model_outshape[-1]
 
-  res = None
-  if withpred:
-    if isclassification:
-      if not (doprobabilities or withconfidence) and hasattr(model, 'predict_classes'):
-        try:
-          res = model.predict_classes( x=samples, batch_size=batch_size )
-        except AttributeError:
-          pass
-    if not isinstance( res, np.ndarray ):
-      res = model.predict( x=samples, batch_size=batch_size )
-      if img2img:
-        res = adaptFromModel_img2img(model, res, sample_data_format=data_format)
-      else:
-        res = adaptFromModel(model,res,inp_shape,ret_data_format=data_format)
-      ret.update({dgbkeys.preddictstr: res})
+  if not (withpred or (isclassification and (doprobabilities or withconfidence))):
+    return ret
 
-  if isclassification and (doprobabilities or withconfidence or withpred):
-    if len(ret)<1:
-      allprobs = model.predict( x=samples, batch_size=batch_size )
-      allprobs = adaptFromModel(model,allprobs,inp_shape,ret_data_format=data_format)
-    else:
-      allprobs = ret[dgbkeys.preddictstr]
-    indices = None
-    if withconfidence or not img2img or (img2img and nroutputs>2):
-      N = 2
-      if img2img:
-        indices = np.argpartition(allprobs,-N,axis=1)[:,-N:]
-      else:
-        indices = np.argpartition(allprobs,-N,axis=0)[-N:]
-    if withpred and isinstance( indices, np.ndarray ):
-      if img2img:
-        ret.update({dgbkeys.preddictstr: indices[:,-1:]})
-      else:
-        ret.update({dgbkeys.preddictstr: indices[-1:]})
-    if doprobabilities and len(withprobs) > 0:
-      res = np.copy(allprobs[withprobs])
-      ret.update({dgbkeys.probadictstr: res})
-    if withconfidence:
-      x = allprobs.shape[-1]
-      sortedprobs = allprobs[indices.ravel(),np.tile(np.arange(x),N)].reshape(N,x)
-      res = np.diff(sortedprobs,axis=0)
-      ret.update({dgbkeys.confdictstr: res})
+  allprobs = model.predict( x=samples, batch_size=batch_size )
+  if img2img:
+    allprobs = adaptFromModel_img2img(model, allprobs, sample_data_format=data_format)
+  else:
+    allprobs = adaptFromModel(model,allprobs,inp_shape,ret_data_format=data_format)
 
-  return ret
+  return getApplyResults( allprobs, isclassification, nroutputs, withpred, withprobs, withconfidence, \
+                          doprobabilities, axis=1 if img2img else 0, img2img=img2img, out=out )
 
 def adaptToModel_img2img(model, samples, sample_data_format='channels_first'):
   model_data_format = get_data_format( model )
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import onnx
 import onnxruntime as rt
@@ -5,6 +6,53 @@ import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
 import odpy.hdf5 as odhdf5
 import dgbpy.onnx_classes as oc
+from dgbpy.mlio import getApplyResults
+
+onnx_dict = {
+    'batch': 256,
+    'intra_op_threads': 0,
+    'inter_op_threads': 0,
+    'graph_optimization': 'all',
+    'execution_mode': 'sequential',
+    'cache_optimized': True,
+}
+
+graph_optimization_levels = {
+    'disable': rt.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': rt.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': rt.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': rt.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+execution_modes = {
+    'sequential': rt.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': rt.ExecutionMode.ORT_PARALLEL,
+}
+
+def getParams( pars=None ):
+    """ Session parameters: onnx_dict updated with the matching keys of pars
+        (model parameters or apply outputs dict) """
+    ret = onnx_dict.copy()
+    if pars:
+        ret.update( {key: pars[key] for key in onnx_dict if key in pars} )
+    return ret
+
+def getSessionOptions( pars, optimized_model_filepath=None ):
+    opts = rt.SessionOptions()
+    opts.intra_op_num_threads = int(pars['intra_op_threads'])
+    opts.inter_op_num_threads = int(pars['inter_op_threads'])
+    opts.graph_optimization_level = graph_optimization_levels[pars['graph_optimization']]
+    opts.execution_mode = execution_modes[pars['execution_mode']]
+    if optimized_model_filepath:
+        opts.optimized_model_filepath = optimized_model_filepath
+    return opts
+
+def getOptimizedModelFnm( filepath, pars, provider ):
+    """ Cache file of the optimized graph, next to the model: the optimized graph
+        depends on the optimization level and on the execution provider """
+    device = 'cuda' if provider == dgbkeys.onnxcudastr else 'cpu'
+    (base,ext) = os.path.splitext( filepath )
+    return f'{base}.{pars["graph_optimization"]}-{device}.opt{ext}'
 
 def get_model_shape( shape, nrattribs, attribfirst=True ):
     ret = ()
@@ -47,7 +95,7 @@ def getModelDims( model_shape ):
         return 0
     return len(ret)
 
-def load( modelfnm ):
+def load( modelfnm, pars=None ):
     model = None
     h5file = odhdf5.openFile( modelfnm, 'r' )
     modelgrp = h5file['model']
@@ -55,22 +103,59 @@ def load( modelfnm ):
     if savetype == dgbkeys.onnxplfnm:
         modfnm = odhdf5.getText( modelgrp, 'path' )
         modfnm = dgbhdf5.translateFnm( modfnm, modelfnm )
-        model = OnnxModel(str(modfnm))
+        model = OnnxModel(str(modfnm), pars)
     h5file.close()
     return model
 
 class OnnxModel():
-    def __init__(self, filepath : str):
+    def __init__(self, filepath : str, pars=None):
         self.name = filepath
+        self.pars = getParams( pars )
         self.onnx_mdl = onnx.load(self.name)
         self.metadata = {x.key: x.value for x in self.onnx_mdl.metadata_props}
         inshape = self.input_shape()
         self.data_format = self.metadata.get('data_format', oc.dataformat(self.onnx_mdl))
         providers = [dgbkeys.onnxcudastr, dgbkeys.onnxcpustr]
+        if dgbkeys.onnxcudastr not in rt.get_available_providers():
+            providers = [dgbkeys.onnxcpustr]
         try:
-            self.session = rt.InferenceSession(self.name, providers=providers)
+            self.session = self._create_session(providers)
         except RuntimeError:
-            self.session = rt.InferenceSession(self.name, providers=[dgbkeys.onnxcpustr])
+            self.session = self._create_session([dgbkeys.onnxcpustr])
+
+    def _create_session(self, providers):
+        pars = self.pars
+        if not pars['cache_optimized'] or pars['graph_optimization'] == 'disable':
+            return rt.InferenceSession(self.name, getSessionOptions(pars), providers=providers)
+        # The layout optimizations of level 'all' are hardware specific: not cached
+        cachepars = pars.copy()
+        if pars['graph_optimization'] == 'all':
+            cachepars['graph_optimization'] = 'extended'
+        optfnm = getOptimizedModelFnm( self.name, cachepars, providers[0] )
+        if not os.path.isfile(optfnm) or os.path.getmtime(optfnm) < os.path.getmtime(self.name):
+            # Written under a name of this process, then moved in place: concurrent
+            # processes never see a partially written file
+            tmpfnm = f'{optfnm}.{os.getpid()}.tmp'
+            try:
+                rt.InferenceSession(self.name, getSessionOptions(cachepars, tmpfnm), providers=providers)
+                os.replace(tmpfnm, optfnm)
+            except Exception:
+                # Optimized model could not be written
+                if os.path.isfile(tmpfnm):
+                    os.remove(tmpfnm)
+                return rt.InferenceSession(self.name, getSessionOptions(pars), providers=providers)
+        loadpars = pars.copy()
+        if pars['graph_optimization'] != 'all':
+            loadpars['graph_optimization'] = 'disable'
+        try:
+            return rt.InferenceSession(optfnm, getSessionOptions(loadpars), providers=providers)
+        except Exception:
+            # Invalid cached model: removed, to be rebuilt by the next load
+            try:
+                os.remove(optfnm)
+            except OSError:
+                pass
+            return rt.InferenceSession(self.name, getSessionOptions(pars), providers=providers)
 
     def __call__(self, inputs):
         self.inputs = self.adaptInput(inputs)
@@ -79,6 +164,41 @@ class OnnxModel():
         ort_outs = self.adaptOutput(ort_outs)
         return ort_outs
 
+    def batch_size(self, batch_size=None):
+        nrbatch = self.input_shape()[0]
+        if nrbatch > 0:
+            # Exported with a fixed batch dimension
+            return nrbatch
+        return batch_size if batch_size else onnx_dict['batch']
+
+    def run(self, inputs, batch_size=None):
+        """Batched inference: the outputs are written in a single preallocated array,
+           bound to the session after the first batch"""
+        inputs = self.adaptInput(inputs)
+        batch_size = self.batch_size(batch_size)
+        inpname = self.session.get_inputs()[0].name
+        outname = self.session.get_outputs()[-1].name
+        binding = self.session.io_binding()
+        ret = None
+        for start in range(0, len(inputs), batch_size):
+            batch = np.ascontiguousarray(inputs[start:start+batch_size])
+            binding.bind_cpu_input(inpname, batch)
+            if ret is None:
+                binding.bind_output(outname)
+            else:
+                outs = rt.OrtValue.ortvalue_from_numpy(ret[start:start+len(batch)])
+                binding.bind_ortvalue_output(outname, outs)
+            self.session.run_with_iobinding(binding)
+            if ret is None:
+                outs = binding.copy_outputs_to_cpu()[0]
+                ret = np.empty((len(inputs),)+outs.shape[1:], dtype=outs.dtype)
+                ret[:len(outs)] = outs
+            binding.clear_binding_inputs()
+            binding.clear_binding_outputs()
+        if ret is None:
+            return np.empty((0,))
+        return self.adaptOutput(ret)
+
     def adaptInput(self, samples, sample_data_format='channels_first'):
         if self.data_format == 'channels_first':
             if sample_data_format == 'channels_last':
@@ -122,62 +242,13 @@ class OnnxModel():
     def num_inputs(self):
         return len(self.onnx_mdl.graph.input)
 
-def apply( model, infos, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, dictinpshape, dictoutshape, nroutputs):
-    ret = {}
-    res = None
+def apply( model, infos, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, dictinpshape, dictoutshape, nroutputs, batch_size=None, out=None):
     img2img = dgbhdf5.isImg2Img(infos)
     nroutputs = dgbhdf5.getNrOutputs(infos)
 
-    predictions = []
-    for input in samples:
-        input = np.expand_dims(input, axis=0)
-        pred = model(input)
-        for _ in pred:
-            predictions.append(_)
-
-    predictions = np.array(predictions)
-    if withpred:
-        if isclassification:
-            if not (doprobabilities or withconfidence):
-                if nroutputs > 2:
-                    predictions = np.argmax(predictions, axis=1)
-                if nroutputs == 2:
-                    predictions = predictions[:, -1]
-
-        if not isinstance(res, np.ndarray):
-            res = predictions
-            ret.update({dgbkeys.preddictstr: res})
-
-    if isclassification and (doprobabilities or withconfidence or withpred):
-        if len(ret)<1:
-            allprobs = (np.array(predictions)).transpose()
-        else:
-            allprobs = ret[dgbkeys.preddictstr]
-        indices = None
-        if withconfidence or not img2img or (img2img and nroutputs>2):
-            N = 2
-            if img2img:
-                indices = np.argpartition(allprobs,-N,axis=1)[:,-N:]
-            else:
-                indices = np.argpartition(allprobs,-N,axis=0)[-N:]
-        if withpred and isinstance( indices, np.ndarray ):
-            if img2img:
-                ret.update({dgbkeys.preddictstr: indices[:,-1:]})
-            else:
-                ret.update({dgbkeys.preddictstr: indices[-1:]})
-        if doprobabilities and len(withprobs) > 0:
-            res = np.copy(allprobs[withprobs])
-            ret.update({dgbkeys.probadictstr: res})
-        if withconfidence:
-            N = 2
-            predictions = np.array(predictions)
-            x = predictions.shape[0]
-            indices = np.argpartition(predictions.transpose(),-N,axis=0)[-N:].transpose()
-            sortedprobs = predictions.transpose()[indices.ravel(),np.tile(np.arange(x),N)].reshape(N,x)
-            res = np.diff(sortedprobs,axis=0)
-            ret.update({dgbkeys.confdictstr: res})
-
-    return ret
+    predictions = model.run(samples, batch_size)
+    return getApplyResults(predictions, isclassification, nroutputs, withpred, withprobs, withconfidence,
+                           doprobabilities, axis=1, img2img=img2img, keepdims=False, out=out)
 
 
     
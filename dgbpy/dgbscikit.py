@@ -27,7 +27,6 @@ try:
   from sklearn.metrics import silhouette_score
 except ModuleNotFoundError:
   pass
-from scipy.spatial import distance
 from odpy.common import log_msg, redirect_stdout, restore_stdout, get_settings_filename
 from odpy.oscommand import printProcessTime
 import odpy.hdf5 as odhdf5
@@ -114,6 +113,9 @@ kerneltypes = [\
 savetypes = ( 'onnx', 'joblib', 'pickle' )
 defsavetype = savetypes[0]
 xgboostjson = 'xgboostjson'
+onnxthreadkeys = ( 'intra_op_threads', 'inter_op_threads' )
+# Maximum number of elements of the sample-center distance matrix of a block
+clusterblockelems = 4194304
 
 defstoragetype = dgbhdf5.StorageType.LOCAL.value
 
@@ -185,6 +187,94 @@ def getDefaultNNKernel( isclass, uiname=True ):
     kernelstr = linkernel
   return dgbkeys.getNameFromList( kerneltypes, kernelstr, uiname )
 
+def getNearestClusters(samples, centers, blocksize=None):
+  """
+    Find the nearest cluster center of each sample, and its Euclidean distance.
+
+    The squared distances are computed in matrix form, |x|^2 - 2 x.c + |c|^2, for blocks of
+    samples, so that the distance matrix of a block has at most clusterblockelems elements.
+
+    Parameters
+    ----------
+    samples : array-like of shape (n_samples, n_features)
+        The input data samples.
+
+    centers : array-like of shape (n_clusters, n_features)
+        The cluster centers.
+
+    blocksize : int, optional
+        Number of samples per block. By default derived from clusterblockelems.
+
+    Returns
+    -------
+    labels : ndarray of shape (n_samples,)
+        Index of the nearest center of each sample.
+
+    min_distances : ndarray of shape (n_samples,)
+        Euclidean distance from each sample to its nearest center.
+  """
+
+  samples = np.reshape( samples, (len(samples),-1) )
+  centers = np.asarray( centers, dtype=np.float64 )
+  if blocksize is None:
+    blocksize = max( 1, clusterblockelems // len(centers) )
+  centers_sqnorm = np.einsum( 'ij,ij->i', centers, centers )
+  labels = np.empty( len(samples), dtype=np.int64 )
+  min_distances = np.empty( len(samples), dtype=np.float64 )
+  for start in range(0, len(samples), blocksize):
+    block = samples[start:start+blocksize].astype( np.float64, copy=False )
+    sqdists = block @ centers.T
+    sqdists *= -2
+    sqdists += centers_sqnorm
+    blocklabels = np.argmin( sqdists, axis=1 )
+    labels[start:start+len(block)] = blocklabels
+    nearest = sqdists[np.arange(len(block)),blocklabels] + np.einsum( 'ij,ij->i', block, block )
+    np.sqrt( np.maximum(nearest, 0, out=nearest), out=min_distances[start:start+len(block)] )
+  return (labels, min_distances)
+
+def setClusterCenters(model, samples, labels=None):
+  """
+    Store the centers of the clusters found by a SpectralClustering model.
+
+    SpectralClustering cannot predict new samples: the mean of the training samples of each
+    cluster is stored in the model as `cluster_centers_`, with their labels in `center_labels_`,
+    so that new samples can be assigned to the nearest center at apply time.
+
+    Parameters
+    ----------
+    model : SpectralClustering
+        The fitted clustering model.
+
+    samples : array-like of shape (n_samples, n_features)
+        The samples the model was fitted on.
+
+    labels : array-like of shape (n_samples,), optional
+        The cluster labels of the samples, `model.labels_` by default.
+  """
+
+  if labels is None:
+    labels = model.labels_
+  samples = np.reshape( samples, (len(samples),-1) )
+  center_labels, inverse = np.unique( labels, return_inverse=True )
+  counts = np.bincount( inverse )
+  centers = np.zeros( (len(center_labels),samples.shape[1]), dtype=np.float64 )
+  np.add.at( centers, inverse, samples )
+  model.cluster_centers_ = centers / counts[:,np.newaxis]
+  model.center_labels_ = center_labels
+
+def predictClusters(model, samples):
+  """
+    Cluster labels of samples: a SpectralClustering model with stored centers (see setClusterCenters)
+    assigns each sample to its nearest center, instead of fitting the samples again.
+  """
+
+  if isinstance(model, SpectralClustering):
+    if not hasattr(model, 'cluster_centers_'):
+      return model.fit_predict( samples )
+    (labels, _) = getNearestClusters( samples, model.cluster_centers_ )
+    return model.center_labels_[labels]
+  return model.predict( samples )
+
 def getClusterDistances(model, samples):
   """
     Calculate the minimum normalized Euclidean distance from each sample to the nearest cluster center.
@@ -212,10 +302,13 @@ def getClusterDistances(model, samples):
     if isinstance(model, KMeans) or isinstance(model, MeanShift):
       cluster_centers = model.cluster_centers_
     elif isinstance(model, SpectralClustering):
-      labels = model.fit_predict(samples)
-      cluster_centers = np.array([samples[labels == i].mean(axis=0) for i in np.unique(labels)])
-    distances = np.array([[distance.euclidean(x, center) for center in cluster_centers] for x in samples])
-    min_distances = distances.min(axis=1)
+      if hasattr(model, 'cluster_centers_'):
+        cluster_centers = model.cluster_centers_
+      else:
+        # Model trained without stored centers
+        labels = model.fit_predict(samples)
+        cluster_centers = np.array([samples[labels == i].mean(axis=0) for i in np.unique(labels)])
+    (_, min_distances) = getNearestClusters( samples, cluster_centers )
     scaler = MinMaxScaler()
     min_distances_normalized = scaler.fit_transform(min_distances.reshape(-1, 1)).flatten()
     return min_distances_normalized
@@ -546,6 +639,8 @@ def getScaler( x_train, byattrib ):
   scaler.n_samples_seen_ = len(mean)
   return scaler
 
+scaleblockbytes = 4*1024*1024
+
 def transform( samples, mean, stddev ):
   samples -= mean
   if stddev:
@@ -557,6 +652,64 @@ def transformBack( samples, mean, stddev ):
   samples += mean
   return samples
 
+def getScaleFactors( scaler, nrattribs ):
+  """ Gets the mean and scale of a StandardScaler for each attribute
+
+  Parameters:
+    * scaler sklearn.preprocessing.StandardScaler object
+    * nrattribs int: number of attributes (size of axis 1) of the samples
+
+  Returns:
+    * tuple: mean and scale arrays, of size 1 for a global scaler.
+      Attributes beyond those of the scaler reuse the last values,
+      zero scales are replaced by 1.
+  """
+
+  nrseen = int( scaler.n_samples_seen_ )
+  mean = np.atleast_1d( np.asarray(scaler.mean_, dtype=np.float64) )[:nrseen]
+  scale = np.atleast_1d( np.asarray(scaler.scale_, dtype=np.float64) )[:nrseen]
+  if nrseen > 1 and nrattribs > nrseen:
+    mean = np.pad( mean, (0,nrattribs-nrseen), mode='edge' )
+    scale = np.pad( scale, (0,nrattribs-nrseen), mode='edge' )
+  elif nrseen > 1:
+    mean = mean[:nrattribs]
+    scale = scale[:nrattribs]
+  scale = np.where( scale == 0, 1, scale )
+  return (mean, scale)
+
+def standardize( samples, mean, scale, inverse=False ):
+  """ Applies a standardization in place, for all attributes at once
+
+  The mean and scale are broadcast along axis 1 (attributes) of the samples,
+  which are processed by blocks along axis 0 that fit in cache.
+
+  Parameters:
+    * samples ndarray: input/output values, modified in place
+    * mean ndarray: mean per attribute, or of size 1 for all values
+    * scale ndarray: non-zero scale per attribute, or of size 1 for all values
+    * inverse Boolean: applies samples*scale+mean if True, (samples-mean)/scale otherwise
+
+  """
+
+  if len(mean) == 1 or samples.ndim < 2:
+    bshape = ()
+  else:
+    bshape = (1,len(mean)) + (1,)*(samples.ndim-2)
+  mean = np.asarray( mean, dtype=samples.dtype ).reshape( bshape )
+  scale = np.asarray( scale, dtype=samples.dtype ).reshape( bshape )
+  if samples.ndim < 1 or len(samples) < 1:
+    return samples
+  step = max( 1, scaleblockbytes // max(1,samples[0].nbytes) )
+  for start in range(0,len(samples),step):
+    block = samples[start:start+step]
+    if inverse:
+      np.multiply( block, scale, out=block )
+      np.add( block, mean, out=block )
+    else:
+      np.subtract( block, mean, out=block )
+      np.divide( block, scale, out=block )
+  return samples
+
 def scale( samples, scaler ):
   """ Applies a scaler transformation to an array of features
   If the scaler is a StandardScaler, the returned samples have 
@@ -579,16 +732,10 @@ def scale( samples, scaler ):
     samples = samples.reshape( shape )
   elif isinstance(scaler,RangedScaler):
     samples = scaler.transform( samples )
-  elif scaler.n_samples_seen_ == 1:
-    samples = transform( samples, scaler.mean_[0], scaler.scale_[0] )
   else:
-    mean = 0.0
-    scale = 1.0
-    for i in range(samples.shape[1]):
-      if i<scaler.n_samples_seen_:
-        mean = scaler.mean_[i]
-        scale = scaler.scale_[i]
-      samples[:,i] = transform( samples[:,i], mean, scale )
+    nrattribs = samples.shape[1] if samples.ndim > 1 else 1
+    mean, stddev = getScaleFactors( scaler, nrattribs )
+    samples = standardize( samples, mean, stddev )
 
   return samples
 
@@ -608,16 +755,10 @@ def unscale( samples, scaler ):
     shape = samples.shape
     samples = scaler.inverse_transform( samples.reshape((np.prod(shape),1)) )
     samples = samples.reshape( shape )
-  elif scaler.n_samples_seen_ == 1:
-    samples = transformBack( samples, scaler.mean_[0], scaler.scale_[0] )
   else:
-    mean = 0.0
-    scale = 1.0
-    for i in range(samples.shape[1]):
-      if i<scaler.n_samples_seen_:
-        mean = scaler.mean_[i]
-        scale = scaler.scale_[i]
-      samples[:,i] = transformBack( samples[:,i], mean, scale )
+    nrattribs = samples.shape[1] if samples.ndim > 1 else 1
+    mean, stddev = getScaleFactors( scaler, nrattribs )
+    samples = standardize( samples, mean, stddev, inverse=True )
 
   return samples
 
@@ -803,6 +944,8 @@ def train(model, trainingdp):
     model.verbose = 51
     ret = model.fit(x_train,y_train)
     restore_stdout()
+    if isinstance(model, SpectralClustering):
+      setClusterCenters( model, x_train )
     printProcessTime( 'Training with scikit-learn', False, print_fn=log_msg, withprocline=False )
     assessQuality( model, trainingdp )
     return ret
@@ -816,10 +959,7 @@ def assessQuality( model, trainingdp ):
   if isClustering( model ):
     try:
       x_validate = trainingdp[dgbkeys.xvaliddictstr]
-      if isinstance(model, SpectralClustering):
-        y_predicted = model.fit_predict(x_validate)
-      else:
-        y_predicted = model.predict(x_validate)
+      y_predicted = predictClusters( model, x_validate )
       silhouette_avg = silhouette_score(x_validate, y_predicted)
       log_msg( '\nAverage Silhouette Score: ', "%.4f" % silhouette_avg, '\n' )
     except Exception as e:
@@ -904,7 +1044,7 @@ def save( model, outfnm, save_type=defsavetype ):
     odhdf5.setAttr( modelgrp, 'path', joutfnm )
   h5file.close()
 
-def load( modelfnm ):
+def load( modelfnm, pars=None ):
   model = None
   h5file = odhdf5.openFile( modelfnm, 'r' )
   modelgrp = h5file['model']
@@ -913,7 +1053,10 @@ def load( modelfnm ):
     modfnm = odhdf5.getText( modelgrp, 'path' )
     modfnm = dgbhdf5.translateFnm( modfnm, modelfnm )
     from dgbpy.sklearn_classes import OnnxScikitModel
-    model = OnnxScikitModel( str(modfnm) )
+    threadpars = {}
+    if pars:
+      threadpars = {key: pars[key] for key in onnxthreadkeys if key in pars}
+    model = OnnxScikitModel( str(modfnm), **threadpars )
   if savetype == savetypes[1]:
     import joblib
     modfnm = odhdf5.getText( modelgrp, 'path' )
@@ -956,9 +1099,14 @@ def apply( model, samples, scaler, isclassification, withpred, withprobs, withco
 
   ret = {}
   res = None
-  if withpred:
-    if isinstance(model, SpectralClustering):
-      res = np.transpose( model.fit_predict( samples ) )
+  probs = None
+  needprobs = isclassification and (doprobabilities or withconfidence)
+  if withpred and needprobs and getattr(model,'predict_with_proba',None):
+    (res,probs) = model.predict_with_proba( samples )
+    ret.update({dgbkeys.preddictstr: np.transpose( res )})
+  elif withpred:
+    if isClustering(model):
+      res = np.transpose( predictClusters( model, samples ) )
     else:
       res = np.transpose( model.predict( samples ) )
     ret.update({dgbkeys.preddictstr: res})
@@ -967,8 +1115,10 @@ def apply( model, samples, scaler, isclassification, withpred, withprobs, withco
     res = np.transpose( getClusterDistances( model, samples) )
     ret.update({dgbkeys.matchdictstr: res})
 
-  if isclassification and (doprobabilities or withconfidence):
-    res = np.transpose( model.predict_proba( samples ) )
+  if needprobs:
+    if probs is None:
+      probs = model.predict_proba( samples )
+    res = np.transpose( probs )
     ret.update({dgbkeys.probadictstr: res})
 
   return ret
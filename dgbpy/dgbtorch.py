@@ -15,7 +15,7 @@ import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
 import odpy.hdf5 as odhdf5
 import odpy.common as odcommon
-from dgbpy.mlio import getStoredParams
+from dgbpy.mlio import getStoredParams, getApplyResults
 
 try:
   import torch
@@ -120,7 +120,11 @@ torch_dict = {
     'userandomseed': 42,
     'stopaftercurrentepoch': False,
     'tmpsavedict': tmp_save_dict,
-    'summary': None
+    'summary': None,
+    'streaming': False,
+    'prefetch': False,
+    'batchsampler': False,
+    'nbworkers': 0
 }
 
 settings_mltrain_path = odcommon.get_settings_filename('settings_mltrain.json')
@@ -201,7 +205,11 @@ def getParams(
     userandomseed=torch_dict['userandomseed'],
     stopaftercurrentepoch=torch_dict['stopaftercurrentepoch'],
     tmpsavedict=torch_dict['tmpsavedict'],
-    summary=torch_dict['summary']):
+    summary=torch_dict['summary'],
+    streaming=torch_dict['streaming'],
+    prefetch=torch_dict['prefetch'],
+    batchsampler=torch_dict['batchsampler'],
+    nbworkers=torch_dict['nbworkers']):
   ret = {
     dgbkeys.decimkeystr: dodec,
     'type': nntype,
@@ -224,6 +232,10 @@ def getParams(
     'stopaftercurrentepoch': stopaftercurrentepoch,
     'tmpsavedict':tmpsavedict,
     'summary': summary,
+    'streaming': streaming,
+    'prefetch': prefetch,
+    'batchsampler': batchsampler,
+    'nbworkers': nbworkers,
   }
   if prefercpu == None:
     prefercpu = not can_use_gpu()
@@ -496,7 +508,11 @@ def setSeed(seed):
 def train(model, imgdp, params, cbfn=None, logdir=None, silent=False, metrics=False, tempnm=None, outfnm=None):
     from dgbpy.torch_classes import Trainer, AdaptiveLR
     setSeed(params['userandomseed'])
-    trainloader, testloader = DataGenerator(imgdp,batchsize=params['batch'],scaler=params['scale'],transform=params['transform'])
+    trainloader, testloader = DataGenerator(imgdp,batchsize=params['batch'],scaler=params['scale'],transform=params['transform'],
+                                            streaming=params.get('streaming', False),
+                                            prefetch=params.get('prefetch', False),
+                                            batchsampler=params.get('batchsampler', False),
+                                            nbworkers=params.get('nbworkers', 0))
     info = imgdp[dgbkeys.infodictstr]
     criterion = get_criterion(info, params)
     optimizer = torch.optim.Adam(model.parameters(), lr=params['learnrate'])
@@ -536,7 +552,10 @@ def train(model, imgdp, params, cbfn=None, logdir=None, silent=False, metrics=Fa
         stopaftercurrentepoch =  params['stopaftercurrentepoch'],
         tmpsavedict = tmp_save_dict
     )
-    model = trainer.fit(cbs = cbfn)
+    try:
+      model = trainer.fit(cbs = cbfn)
+    finally:
+      closePrefetchers(trainloader, testloader)
     return model
 
 def transfer(model, info=None ):
@@ -598,21 +617,20 @@ def resume( model, infos):
     model = model.convert_to_torch()
   return model
 
-def apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, batch_size = torch_dict['batch'] ):
+def apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, batch_size = torch_dict['batch'], out=None ):
   attribs = dgbhdf5.getNrAttribs(info)
   model_shape = get_model_shape(info[dgbkeys.inpshapedictstr], attribs, True)
   ndims = getModelDims(model_shape, 'channels_first')
   sampleDataset = tc.DatasetApply(samples, info, isclassification, 1, ndims=ndims)
-  ret = {}
-  res = None
   img2img = dgbhdf5.isImg2Img(info)
+  if not batch_size: batch_size = torch_dict['batch']
   
+  nrsamples = len(sampleDataset)
+  padsize = None
   if info[dgbkeys.learntypedictstr] == dgbkeys.seisclasstypestr or \
       info[dgbkeys.learntypedictstr] == dgbkeys.loglogtypestr:
-      drop_last = True
-  else:
-    drop_last = False
-  dataloader = getDataLoader(sampleDataset, batch_size=batch_size, drop_last=drop_last)
+      # Last batch padded to the full batch size: the model only sees static shapes
+      padsize = batch_size
   if isclassification:
     nroutputs = len(info[dgbkeys.classesdictstr])
   else:
@@ -624,64 +642,21 @@ def apply( model, info, samples, scaler, isclassification, withpred, withprobs,
     device = get_device_type()
     model = model.to(device)
 
-  predictions = []
+  predictions = None
   model.eval()
-  for input in dataloader:
-      with torch.no_grad():
-        input = input.to(device)
-        out = model(input)
-        pred = out.detach().cpu().numpy()
-        for _ in pred:
-          predictions.append(_)
-
-  predictions = np.array(predictions)
-  if withpred:
-    if isclassification:
-      if not (doprobabilities or withconfidence):
-        if nroutputs > 2:
-            predictions = np.argmax(predictions, axis=1)
-        if nroutputs == 2 and samples.shape != predictions.shape:
-            predictions = predictions[:, -1]
-        ret.update({dgbkeys.preddictstr: predictions})
-        
-    else: ret.update({dgbkeys.preddictstr: predictions})
-
-  if isclassification and (doprobabilities or withconfidence or withpred):
-    if len(ret)<1:
-      allprobs = (np.array(predictions)).transpose()
-    else:
-      allprobs = ret[dgbkeys.preddictstr]
-    indices = None
-    if withconfidence or not img2img or (img2img and nroutputs>2):
-      N = 2
-      if img2img:
-        indices = np.argpartition(allprobs,-N,axis=1)[:,-N:]
-      else:
-        indices = np.argpartition(allprobs,-N,axis=0)[-N:]
-    if withpred and isinstance( indices, np.ndarray ):
-      if img2img:
-        ret.update({dgbkeys.preddictstr: indices[:,-1:]})
-      else:
-        ret.update({dgbkeys.preddictstr: indices[-1:]})
-    if doprobabilities and len(withprobs) > 0:
-      res = np.copy(allprobs[withprobs])
-      ret.update({dgbkeys.probadictstr: res})
-    if withconfidence:
-      N = 2
-      predictions_prob = np.array(predictions)
-      x = predictions_prob.shape[0]
-      indices = np.argpartition(predictions_prob.transpose(),-N,axis=0)[-N:].transpose()
-      sortedprobs = predictions_prob.transpose()[indices.ravel(),np.tile(np.arange(x),N)].reshape(N,x)
-      res = np.diff(sortedprobs,axis=0)
-      ret.update({dgbkeys.confdictstr: res})
-
-  if withpred:
-    ret.update({dgbkeys.preddictstr: predictions})
-  
-  if doprobabilities:
-    ret.update({dgbkeys.probadictstr: predictions[withprobs]})  
-
-  return ret
+  with torch.inference_mode():
+    for start in range(0, nrsamples, batch_size):
+      stop = min(start+batch_size, nrsamples)
+      input = sampleDataset.get_batch(start, stop, padsize).to(device, non_blocking=True)
+      batchout = model(input)[:stop-start].cpu().numpy()
+      if predictions is None:
+        predictions = np.empty((nrsamples,)+batchout.shape[1:], dtype=batchout.dtype)
+      predictions[start:stop] = batchout
+
+  if predictions is None:
+    return {}
+  return getApplyResults( predictions, isclassification, nroutputs, withpred, withprobs, withconfidence, \
+                          doprobabilities, axis=1, img2img=img2img, keepdims=False, out=out )
 
 def getDataLoader(dataset, batch_size=torch_dict['batch'], drop_last=False):
     if not batch_size: batch_size = torch_dict['batch']
@@ -702,15 +677,57 @@ class ChunkedDataLoader(DataLoader):
         self.dataset.set_transform_seed()
 
     def get_batchsize(self):
+        if self.batch_size is None:
+            return self.sampler.batch_size
         return self.batch_size
 
     def __iter__(self):
         for batch in super().__iter__():
             yield batch
 
-def getDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch']):
-    trainloader = ChunkedDataLoader(dataset=traindataset, batch_size=batchsize, shuffle=False, drop_last=True)
-    testloader= ChunkedDataLoader(dataset=testdataset, batch_size=batchsize, shuffle=False, drop_last=True)
+def seedWorker(worker_id):
+    """
+        Seeds each DataLoader worker deterministically from the transform seed of its dataset
+    """
+    from torch.utils.data import get_worker_info
+    seed = getattr(get_worker_info().dataset, 'transform_seed', None)
+    if seed is None:
+        seed = torch.initial_seed()
+    seed = (seed + worker_id) % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def getWorkerPars(dataset, nbworkers):
+    """
+        DataLoader arguments for parallel loading. The workers are not persistent,
+        so that they pick up the chunk that is current at the start of each epoch.
+    """
+    if not nbworkers or nbworkers < 1:
+        return {}
+    dataset.sharememory = True
+    return {
+        'num_workers': nbworkers,
+        'worker_init_fn': seedWorker,
+        'pin_memory': torch.cuda.is_available(),
+    }
+
+def getBatchSamplerLoader(dataset, batchsize, nbworkers=0):
+    """
+        Data loader passing each batch of indices to the dataset at once,
+        skipping the per-sample indexing and the collate step
+    """
+    from torch.utils.data import BatchSampler, SequentialSampler
+    sampler = BatchSampler(SequentialSampler(dataset), batch_size=batchsize, drop_last=True)
+    return ChunkedDataLoader(dataset=dataset, batch_size=None, sampler=sampler, **getWorkerPars(dataset, nbworkers))
+
+def getDataLoaders(traindataset, testdataset, batchsize=torch_dict['batch'], batchsampler=False, nbworkers=0):
+    if batchsampler and not isinstance(traindataset, torch.utils.data.IterableDataset):
+        return getBatchSamplerLoader(traindataset, batchsize, nbworkers), getBatchSamplerLoader(testdataset, batchsize, nbworkers)
+    trainloader = ChunkedDataLoader(dataset=traindataset, batch_size=batchsize, shuffle=False, drop_last=True,
+                                    **getWorkerPars(traindataset, nbworkers))
+    testloader= ChunkedDataLoader(dataset=testdataset, batch_size=batchsize, shuffle=False, drop_last=True,
+                                  **getWorkerPars(testdataset, nbworkers))
     return trainloader, testloader
 
 def getDatasetPars(imgdp, _forvalid):
@@ -727,10 +744,31 @@ def getDatasetPars(imgdp, _forvalid):
     ndims = getModelDims(model_shape, True)
     return x_data, y_data, info, inp_ch, ndims
 
-def DataGenerator(imgdp, batchsize, scaler=None, transform=list()):
-    from dgbpy.torch_classes import TrainDatasetClass, TestDatasetClass
-    train_dataset = TrainDatasetClass(imgdp, scaler, transform=transform)
-    test_dataset = TestDatasetClass(imgdp, scaler)
+def setPrefetchers(traindataset, testdataset):
+    from dgbpy.mlapply import ChunkPrefetcher
+    info = traindataset.imgdp[dgbkeys.infodictstr]
+    traindataset.prefetcher = ChunkPrefetcher(info, scale=traindataset.isDefScaler)
+    if traindataset.isDefScaler:
+        testdataset.prefetcher = traindataset.prefetcher
+    else:
+        testdataset.prefetcher = ChunkPrefetcher(info, scale=True)
+
+def closePrefetchers(*dataloaders):
+    for dataloader in dataloaders:
+        prefetcher = getattr(dataloader.dataset, 'prefetcher', None)
+        if prefetcher:
+            prefetcher.close()
+
+def DataGenerator(imgdp, batchsize, scaler=None, transform=list(), streaming=False, prefetch=False, batchsampler=False, nbworkers=0):
+    from dgbpy.torch_classes import TrainDatasetClass, TestDatasetClass, StreamingDatasetClass
+    if streaming:
+        train_dataset = StreamingDatasetClass(imgdp, scaler, transform=transform)
+        test_dataset = StreamingDatasetClass(imgdp, scaler, forvalid=True)
+    else:
+        train_dataset = TrainDatasetClass(imgdp, scaler, transform=transform)
+        test_dataset = TestDatasetClass(imgdp, scaler)
+        if prefetch:
+            setPrefetchers(train_dataset, test_dataset)
 
-    trainloader, testloader = getDataLoaders(train_dataset, test_dataset, batchsize)
+    trainloader, testloader = getDataLoaders(train_dataset, test_dataset, batchsize, batchsampler=batchsampler, nbworkers=nbworkers)
     return trainloader, testloader
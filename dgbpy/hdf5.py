@@ -349,6 +349,58 @@ def getOutdType( classinfo, hasunlabels ):
     else:
       return np.uint64
 
+def getSortedSelection( dsetnms ):
+  try:
+    idxs = np.asarray( dsetnms, dtype=np.int64 )
+  except (TypeError,ValueError):
+    return (None,None)
+  if idxs.ndim != 1:
+    return (None,None)
+  return np.unique( idxs, return_inverse=True )
+
+def readSelection( dset, dsetnms, arr, asis=False ):
+  """ Reads the examples dsetnms of dataset dset into the preallocated arr
+
+  The selection is sorted and read in a single hyperslab (dense selection)
+  or fancy-index (sparse selection) read, then scattered back into arr
+  in the requested order.
+
+  Parameters:
+    * dset (h5py.Dataset): examples dataset, first axis is the example index
+    * dsetnms (list): example indices to read, in output order
+    * arr (np.ndarray): preallocated output of shape (len(dsetnms),...)
+    * asis (bool): examples are copied without np.resize, for scalar targets
+
+  Returns:
+    * bool: False if the selection cannot be read in bulk
+  """
+
+  uidxs, order = getSortedSelection( dsetnms )
+  if uidxs is None:
+    return False
+  if len(uidxs) < 1:
+    return True
+  first = int(uidxs[0])
+  last = int(uidxs[-1])
+  if first < 0 or last >= len(dset):
+    return False
+  if last-first+1 <= 2*len(uidxs):
+    data = dset[first:last+1]
+    if len(data) != len(uidxs):
+      data = data[uidxs-first]
+  else:
+    data = dset[uidxs]
+
+  if len(order) != len(uidxs) or np.any(order != np.arange(len(order))):
+    data = data[order]
+  itemshape = arr.shape[1:]
+  if data[0].size == np.prod(itemshape, dtype=np.int64):
+    arr[...] = data.reshape( arr.shape )
+  else:
+    for idx in range(len(arr)):
+      arr[idx] = data[idx] if asis else np.resize( data[idx], itemshape )
+  return True
+
 def getCubeLets_img2img_multitarget( infos, collection, groupnm ):
   inpnrattribs = getNrAttribs( infos )
   outnrattribs = getNrOutputs( infos )
@@ -379,11 +431,13 @@ def getCubeLets_img2img_multitarget( infos, collection, groupnm ):
   else:
     inputs = np.empty( inparrshape, np.float32 )
     outputs = np.empty( outarrshape, outdtype )
-    for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
-      dset = x_data[dsetnm]
-      odset = y_data[dsetnm]
-      inputs[idx] = np.resize( dset, inputs[idx].shape )
-      outputs[idx] = np.resize( odset, outputs[idx].shape )
+    if not readSelection( x_data, dsetnms, inputs ) or \
+       not readSelection( y_data, dsetnms, outputs ):
+      for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
+        dset = x_data[dsetnm]
+        odset = y_data[dsetnm]
+        inputs[idx] = np.resize( dset, inputs[idx].shape )
+        outputs[idx] = np.resize( odset, outputs[idx].shape )
 
   hasdata = len(inputs)>0 and len(outputs)>0
   h5file.close()
@@ -392,6 +446,33 @@ def getCubeLets_img2img_multitarget( infos, collection, groupnm ):
             ytraindictstr: outputs
           } if hasdata else {}
 
+def getCubeLetBlocks( infos, collection, blocksize ):
+  """ Splits the example selection of a group into blocks of sorted examples
+
+  Parameters:
+    * infos (dict): information about example file
+    * collection (dict): example indices per collection of a group
+    * blocksize (int): maximum number of examples per block
+
+  Returns:
+    * list: collections of at most blocksize examples, to be read using getCubeLets
+  """
+
+  multitarget = isImg2Img( infos ) and getNrOutputs( infos ) > 1
+  if multitarget:
+    collections = [collection]
+  else:
+    collections = [{collnm: collection[collnm]} for collnm in collection]
+  blocksize = max( 1, int(blocksize) )
+  ret = list()
+  for coll in collections:
+    sortedcoll = {collnm: np.sort(coll[collnm]) for collnm in coll}
+    nrpts = len( next(iter(sortedcoll.values())) )
+    for start in range(0,nrpts,blocksize):
+      stop = min( start+blocksize, nrpts )
+      ret.append( {collnm: sortedcoll[collnm][start:stop].tolist() for collnm in sortedcoll} )
+  return ret
+
 def getCubeLets( infos, collection, groupnm ):
   if len(collection)< 1:
     return {}
@@ -456,17 +537,21 @@ def getCubeLets( infos, collection, groupnm ):
         output = np.empty( outarrshape, outdtype )
       else:
         output = np.empty( (nrpts,nroutputs), outdtype )
-      for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
-        dset = x_data[dsetnm]
-        if hasydata:
-          odset = y_data[dsetnm]
-
-        cubelets[idx] = np.resize( dset, cubelets[idx].shape )
-        if hasydata:
-          if img2img:
-            output[idx] = np.resize( odset, output[idx].shape )
-          else:
-            output[idx] = np.asarray( odset )
+      bulkread = readSelection( x_data, dsetnms, cubelets )
+      if bulkread and hasydata:
+        bulkread = readSelection( y_data, dsetnms, output, asis=not img2img )
+      if not bulkread:
+        for idx,dsetnm in zip(range(len(dsetnms)),dsetnms):
+          dset = x_data[dsetnm]
+          if hasydata:
+            odset = y_data[dsetnm]
+
+          cubelets[idx] = np.resize( dset, cubelets[idx].shape )
+          if hasydata:
+            if img2img:
+              output[idx] = np.resize( odset, output[idx].shape )
+            else:
+              output[idx] = np.asarray( odset )
 
     allcubelets.append( cubelets )
     alloutputs.append( output )
@@ -538,6 +623,39 @@ def validInfo( info ):
     return False
   return True
 
+def getScalerCacheFnm( filenm ):
+  return os.path.splitext( filenm )[0] + '.scalers.json'
+
+def getScalerCache( filenm ):
+  """ Gets the scaler statistics stored by previous trainings on an example file
+
+  The statistics are kept in a sidecar file next to the example file,
+  keyed by a hash of the example file state and dataset selection.
+
+  Returns:
+    * dict: mean and std per attribute, for each selection hash
+  """
+
+  cachefnm = getScalerCacheFnm( filenm )
+  if not os.path.isfile( cachefnm ):
+    return {}
+  try:
+    with open( cachefnm, 'r' ) as file:
+      return json.load( file )
+  except (OSError,ValueError):
+    return {}
+
+def setScalerCache( filenm, key, stats ):
+  cache = getScalerCache( filenm )
+  cache.update({ key: stats })
+  cachefnm = getScalerCacheFnm( filenm )
+  try:
+    with open( cachefnm+'.tmp', 'w' ) as file:
+      json.dump( cache, file )
+    os.replace( cachefnm+'.tmp', cachefnm )
+  except OSError as e:
+    log_msg( 'Cannot store the scaler statistics:', str(e) )
+
 def getInfo( filenm, quick ):
   h5file = odhdf5.openFile( filenm, 'r' )
   info = odhdf5.getInfoDataSet( h5file )
@@ -717,6 +835,10 @@ def getInfo( filenm, quick ):
       datasetdictstr: getCubeLetNames( retinfo )
       })
 
+  scalercache = getScalerCache( filenm )
+  if len(scalercache) > 0:
+    retinfo.update({scalercachedictstr: scalercache})
+
   if odhdf5.hasAttr(info,'Model.Type' ):
     retinfo.update({plfdictstr: odhdf5.getText(info,'Model.Type')})
   if  odhdf5.hasAttr(info,versionstr):
@@ -76,6 +76,7 @@ class TrainingSequence(Sequence):
       self.transform = []
       self.transform_seed = dgbhdf5.getSeed(self._infos)
       self.transform_copy = transform_copy
+      self.prefetcher = None
       if exfilenm == None:
         self._exfilenm = self._infos[dgbkeys.filedictstr]
       else:
@@ -126,7 +127,10 @@ class TrainingSequence(Sequence):
   def set_fold(self,ichunk,ifold):
     infos = self._infos
     from dgbpy import mlapply as dgbmlapply
-    trainbatch = dgbmlapply.getScaledTrainingDataByInfo( infos,
+    if self.prefetcher:
+      trainbatch = self.prefetcher.get( ichunk, ifold )
+    else:
+      trainbatch = dgbmlapply.getScaledTrainingDataByInfo( infos,
                                               flatten=False,
                                               scale=self.isDefScaler, ichunk=ichunk, ifold=ifold )
     return self.get_data(trainbatch)
@@ -182,15 +186,11 @@ class TrainingSequence(Sequence):
       y_data = self._y_data
       inp_shape = x_data.shape[1:]
       out_shape = y_data.shape[1:]
-      nrpts = len(data_IDs_temp)
-      X = np.empty( (nrpts,*inp_shape), dtype=x_data.dtype )
-      Y = np.empty( (nrpts,*out_shape), dtype=y_data.dtype )
       idx, rem = np.divmod(data_IDs_temp, len(self.transform_multiplier))
-      for i, (ID, _ID) in enumerate(zip(idx, data_IDs_temp)):
-        if self.transform:
-            X[i,], Y[i,] = self.transform(x_data[ID], y_data[ID], _ID, transform_idx=rem[i])
-        else:
-            X[i,], Y[i,] = x_data[ID], y_data[ID]
+      X = x_data[idx]
+      Y = y_data[idx]
+      if self.transform:
+          X, Y = self.transform.transform_batch(X, Y, data_IDs_temp, transform_idxs=rem)
       dictinpshape = self._infos[dgbkeys.inpshapedictstr]
       dictinpshape = tuple( dictinpshape ) if not isinstance(dictinpshape, int) else (dictinpshape,)
       X = dgbkeras.adaptToModel( self._model, X, dictinpshape )
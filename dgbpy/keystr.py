@@ -57,6 +57,7 @@ preddictstr = 'prediction'
 probadictstr = 'probabilities'
 rangedictstr = 'range'
 scaledictstr = 'scale'
+scalercachedictstr = 'scaler_cache'
 seeddictstr = 'seed'
 splitkeystr = 'split'
 outshapedictstr = 'out_shape'
@@ -61,77 +61,179 @@ def computeScaler_( datasets, infos, scalebyattrib ):
     return getScaler( x_data, byattrib=scalebyattrib )
   return None
 
+scalerblockbytes = 256*1024*1024
+
+def getScalerBlockSize( infos ):
+  """ Gets the number of examples read at once during the scaler computation """
+  exshape = dgbhdf5.get_np_shape( infos[dgbkeys.inpshapedictstr], nrattribs=dgbhdf5.getNrAttribs(infos) )
+  exsize = 4 * int(np.prod(exshape))
+  return max( 1, scalerblockbytes // max(1,exsize) )
+
+def getStreamingStats( x_data, byattrib ):
+  """ Gets the statistics of a block of examples
+
+  Parameters:
+    * x_data (ndarray): block of examples
+    * byattrib (bool): statistics per attribute if True, global if False
+
+  Returns:
+    * tuple: number of values, mean and sum of squared deviations from the mean
+  """
+
+  if byattrib:
+    inps = [x_data[:,a] for a in range(x_data.shape[1])]
+  else:
+    inps = [x_data]
+  count = np.array( [inp.size for inp in inps], dtype=np.float64 )
+  mean = np.array( [np.mean(inp,dtype=np.float64) for inp in inps] )
+  m2 = np.array( [np.var(inp,dtype=np.float64) for inp in inps] ) * count
+  return (count, mean, m2)
+
+def mergeStreamingStats( stats, newstats ):
+  """ Merges the statistics of two disjoint sets of examples
+  (parallel variance algorithm of Chan et al.)
+
+  Parameters:
+    * stats (tuple or None): statistics from getStreamingStats, or previous merge
+    * newstats (tuple): statistics from getStreamingStats
+
+  Returns:
+    * tuple: number of values, mean and sum of squared deviations from the mean
+  """
+
+  if stats == None:
+    return newstats
+  (na, meana, m2a) = stats
+  (nb, meanb, m2b) = newstats
+  n = na + nb
+  nz = np.where( n > 0, n, 1 )
+  delta = meanb - meana
+  mean = meana + delta * nb / nz
+  m2 = m2a + m2b + delta * delta * na * nb / nz
+  return (n, mean, m2)
+
 def computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib):
-  chunknb = len(datasets)
-  chunkmean = list()
-  chunkstd = list()
-  chunklen = list()
+  """ Computes the scaler of a group over all chunks in a single pass
+
+  The examples are read in bounded blocks, and the per-attribute
+  mean and variance of all blocks are merged exactly.
+
+  Parameters:
+    * datasets (list): dataset selection of each chunk
+    * infos (dict): information about example file
+    * groupnm (str): name of the group
+    * scalebyattrib (bool):
+
+  Returns:
+    * object: scaler (an instance of sklearn.preprocessing.StandardScaler()), None if no examples
+  """
+
+  blocksize = getScalerBlockSize( infos )
+  stats = None
   for dataset in datasets:
     datasetchunk = dgbmlio.getDatasetsByGroup( dataset, groupnm )
-    chunksize = 0
     for keynm in datasetchunk:
-      data = datasetchunk[keynm]
-      if groupnm in data:
-        dsets = data[groupnm]
-        for subgroupnm in dsets:
-          chunksize += len(dsets[subgroupnm])
-    chunklen.append(chunksize)
-    scaleronechunk = computeScaler_( datasetchunk, infos, scalebyattrib )
-    if scaleronechunk == None:
-      chunkmean.append(0)
-      chunkstd.append(0)
-    else:
-      chunkmean.append(scaleronechunk.mean_)
-      chunkstd.append(scaleronechunk.scale_)
+      collection = datasetchunk[keynm][groupnm]
+      for block in dgbhdf5.getCubeLetBlocks( infos, collection, blocksize ):
+        cubelets = dgbhdf5.getCubeLets( infos, block, groupnm )
+        if len(cubelets) < 1 or len(cubelets[dgbkeys.xtraindictstr]) < 1:
+          continue
+        blockstats = getStreamingStats( cubelets[dgbkeys.xtraindictstr], scalebyattrib )
+        stats = mergeStreamingStats( stats, blockstats )
+
+  if stats == None:
+    return None
+  (count, mean, m2) = stats
+  std = np.sqrt( m2 / np.where(count>0,count,1) )
+  return getNewScaler( mean, std )
 
-  if chunknb < 2:
-    return getNewScaler( chunkmean[0], chunkstd[0] )
-  if scalebyattrib:
-    attrnb = dgbhdf5.getNrAttribs(infos)
-  else:
-    attrnb = 1
-  #Calculate Mean and Var
-  totalmean = list()
-  totalstd = list()
-  for attr in range(attrnb):
-    attrmeansum = 0
-    attrstdsum = 0
-    attrsize = 0
-    for ichunk in range(chunknb):
-      attrchunksize = chunklen[ichunk]
-      if attrchunksize > 0:
-        attrmeansum += chunkmean[ichunk][attr] * attrchunksize
-        attrstdsum += chunkstd[ichunk][attr] * attrchunksize
-      attrsize += attrchunksize
-    if attrsize > 0:
-      attrmeansum /= attrsize
-      attrstdsum /= attrsize
-      totalmean.append( attrmeansum )
-      totalstd.append( attrstdsum )
-  return getNewScaler( totalmean, totalstd )
+def getGroupSelection( datasets, groupnm ):
+  """ Gets the union of the examples of a group over all chunks """
+  sel = {}
+  for dataset in datasets:
+    datasetchunk = dgbmlio.getDatasetsByGroup( dataset, groupnm )
+    for keynm in datasetchunk:
+      collection = datasetchunk[keynm][groupnm]
+      for collnm in collection:
+        if not collnm in sel:
+          sel[collnm] = set()
+        sel[collnm].update( np.asarray(collection[collnm]).tolist() )
+  return {collnm: sorted(sel[collnm]) for collnm in sel}
+
+def getScalerCacheKey( infos, selection, scalebyattrib ):
+  """ Gets the key of a scaler in the scaler statistics cache
+
+  Parameters:
+    * infos (dict): information about example file
+    * selection (dict): examples the scaler is computed on
+    * scalebyattrib (bool):
+
+  Returns:
+    * str: hash of the example file state and selection, None if the file cannot be found
+  """
+
+  import hashlib
+  import json
+  try:
+    stat = os.stat( infos[dgbkeys.filedictstr] )
+  except (OSError,KeyError,TypeError):
+    return None
+  sel = json.dumps( selection, sort_keys=True, default=lambda obj: np.asarray(obj).tolist() )
+  key = '|'.join( (str(stat.st_mtime_ns), str(stat.st_size), str(scalebyattrib), sel) )
+  return hashlib.sha1( key.encode() ).hexdigest()
+
+def getCachedScaler( infos, key ):
+  if key == None or not dgbkeys.scalercachedictstr in infos:
+    return None
+  cache = infos[dgbkeys.scalercachedictstr]
+  if not key in cache:
+    return None
+  log_msg( 'Using the stored scaler statistics' )
+  return getNewScaler( cache[key]['mean'], cache[key]['std'] )
+
+def setCachedScaler( infos, key, scaler ):
+  if key == None or scaler == None:
+    return
+  stats = {
+    'mean': np.asarray(scaler.mean_).tolist(),
+    'std': np.asarray(scaler.scale_).tolist()
+  }
+  if not dgbkeys.scalercachedictstr in infos:
+    infos.update({dgbkeys.scalercachedictstr: {}})
+  infos[dgbkeys.scalercachedictstr].update({key: stats})
+  dgbhdf5.setScalerCache( infos[dgbkeys.filedictstr], key, stats )
 
 def computeScaler( infos, scalebyattrib, force=False ):
   datasets = infos[dgbkeys.trainseldicstr]
   inp = infos[dgbkeys.inputdictstr]
   if infos[dgbkeys.learntypedictstr] == dgbkeys.loglogtypestr:
     if not dgbmlio.hasScaler(infos) or force:
-      printProcessTime( 'Scaler computation', True, print_fn=log_msg )
-      scaler = computeScaler_( datasets[0], infos, scalebyattrib )
-      printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+      key = getScalerCacheKey( infos, datasets[0], scalebyattrib )
+      scaler = None if force else getCachedScaler( infos, key )
+      if scaler == None:
+        printProcessTime( 'Scaler computation', True, print_fn=log_msg )
+        scaler = computeScaler_( datasets[0], infos, scalebyattrib )
+        printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+        setCachedScaler( infos, key, scaler )
       for groupnm in inp:
         inp[groupnm].update({dgbkeys.scaledictstr: scaler})
   else:
     for groupnm in inp:
       if dgbmlio.hasScaler( infos, groupnm ) and not force:
         continue
-      printProcessTime( 'Scaler computation', True, print_fn=log_msg )
-      scaler = computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib)
-      printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+      selection = {groupnm: getGroupSelection( datasets, groupnm )}
+      key = getScalerCacheKey( infos, selection, scalebyattrib )
+      scaler = None if force else getCachedScaler( infos, key )
+      if scaler == None:
+        printProcessTime( 'Scaler computation', True, print_fn=log_msg )
+        scaler = computeChunkedScaler_(datasets,infos,groupnm,scalebyattrib)
+        printProcessTime( 'Scaler computation', False, print_fn=log_msg, withprocline=False )
+        setCachedScaler( infos, key, scaler )
       inp[groupnm].update({dgbkeys.scaledictstr: scaler})
   return infos
 
 def getScaledTrainingData( filenm, flatten=False, scaler=dgbkeys.globalstdtypestr, force=False, 
-                           nbchunks=1, split=1, nbfolds=5, seed=None ):
+                           nbchunks=1, split=1, nbfolds=5, seed=None, streaming=False ):
   """ Gets scaled training data
 
   Parameters:
@@ -140,6 +242,8 @@ def getScaledTrainingData( filenm, flatten=False, scaler=dgbkeys.globalstdtypest
     * scale (bool or iter):
     * nbchunks (int): number of data chunks to be created
     * split (float): size of validation data (between 0-1)
+    * streaming (bool): only return the updated info, the examples are read
+      lazily during training
   """
 
   infos = dgbmlio.getInfo( filenm )
@@ -158,7 +262,7 @@ def getScaledTrainingData( filenm, flatten=False, scaler=dgbkeys.globalstdtypest
   if doscale:
     infos = computeScaler( infos, scalebyattrib, force )
   #Decimate and cross validation, only need to return the updated info
-  if nbchunks > 1 or dgbhdf5.isCrossValidation(infos): 
+  if nbchunks > 1 or dgbhdf5.isCrossValidation(infos) or streaming:
     return {dgbkeys.infodictstr: infos}
   return getScaledTrainingDataByInfo( infos, flatten=flatten, scale=doscale )
 
@@ -177,6 +281,11 @@ def getInputList( datasets ):
     dgbhdf5.dictAddIfNew( datasets[keynm], ret )
   return ret.keys()
 
+def concatenate( arrays ):
+  if len(arrays) == 1:
+    return arrays[0]
+  return np.concatenate( arrays )
+
 def getScaledTrainingDataByInfo( infos, flatten=False, scale=True, ichunk=0, ifold=None ):
   """ Gets scaled training data
 
@@ -223,17 +332,17 @@ def getScaledTrainingDataByInfo( infos, flatten=False, scale=True, ichunk=0, ifo
         y_validate.append( ret[dgbkeys.yvaliddictstr] )
   nrexamples = 0
   if len(x_train)>0:
-    x_train = np.concatenate(x_train)
+    x_train = concatenate(x_train)
     nrexamples += len(x_train)
     ret.update({dgbkeys.xtraindictstr: x_train })
   if len(y_train)>0:
-    ret.update({dgbkeys.ytraindictstr: np.concatenate(y_train) })
+    ret.update({dgbkeys.ytraindictstr: concatenate(y_train) })
   if len(x_validate)>0:
-    x_validate = np.concatenate(x_validate)
+    x_validate = concatenate(x_validate)
     nrexamples += len(x_validate)
     ret.update({dgbkeys.xvaliddictstr: x_validate })
   if len(y_validate)>0:
-    ret.update({dgbkeys.yvaliddictstr: np.concatenate(y_validate) })
+    ret.update({dgbkeys.yvaliddictstr: concatenate(y_validate) })
 
   printProcessTime( 'Data pre-loading', False, print_fn=log_msg, withprocline=False )
 
@@ -253,6 +362,85 @@ def getScaledTrainingDataByInfo( infos, flatten=False, scale=True, ichunk=0, ifo
     ret[dgbkeys.xvaliddictstr] = np.reshape( x_validate, (len(x_validate),-1) )
   return ret
 
+class ChunkPrefetcher:
+  """ Loads the scaled training data of the next chunk/fold in a background
+  thread, while the current one is used for training.
+
+  At most maxresident (1 or 2) chunks are held by the prefetcher: the current one
+  and the next one being loaded. With maxresident=1 the chunks are loaded on request.
+  The consumers use the float32 arrays of the current chunk without copying them,
+  so the peak memory is maxresident chunks. The torch datasets add a copy of the
+  current chunk when they move it to shared memory for their DataLoader workers.
+  """
+
+  def __init__( self, infos, scale=True, maxresident=2 ):
+    from concurrent.futures import ThreadPoolExecutor
+    self.infos = infos
+    self.scale = scale
+    self.maxresident = max( 1, min(2, maxresident) )
+    self.executor = None
+    if self.maxresident > 1:
+      self.executor = ThreadPoolExecutor( max_workers=1 )
+    self.current = (None,None)
+    self.next = (None,None)
+
+  def load( self, key ):
+    (ichunk, ifold) = key
+    return getScaledTrainingDataByInfo( self.infos, flatten=False, scale=self.scale,
+                                        ichunk=ichunk, ifold=ifold )
+
+  def nextKey( self, key ):
+    (ichunk, ifold) = key
+    datasets = self.infos[dgbkeys.trainseldicstr]
+    if dgbhdf5.isCrossValidation( self.infos ) and ifold < len(datasets[ichunk]):
+      return (ichunk, ifold+1)
+    if ichunk+1 < len(datasets):
+      return (ichunk+1, 1)
+    return None
+
+  def discardNext( self ):
+    (key, future) = self.next
+    self.next = (None,None)
+    if future != None and not future.cancel():
+      try:
+        future.result()
+      except Exception:
+        pass
+
+  def get( self, ichunk, ifold=1 ):
+    """ Gets the scaled training data of a chunk/fold, and starts loading the next one
+
+    Parameters:
+      * ichunk (int): chunk index
+      * ifold (int): fold index, only used for cross-validation
+
+    Returns:
+      * dict: as returned by getScaledTrainingDataByInfo
+    """
+
+    key = (ichunk, ifold if ifold else 1)
+    if self.current[0] == key:
+      return self.current[1]
+    self.current = (None,None)
+    if self.next[0] == key:
+      data = self.next[1].result()
+      self.next = (None,None)
+    else:
+      self.discardNext()
+      data = self.load( key )
+    self.current = (key, data)
+    nextkey = self.nextKey( key )
+    if self.executor != None and nextkey != None:
+      self.next = (nextkey, self.executor.submit(self.load, nextkey))
+    return data
+
+  def close( self ):
+    self.discardNext()
+    self.current = (None,None)
+    if self.executor != None:
+      self.executor.shutdown( wait=True )
+      self.executor = None
+
 def getScaler( x_train, byattrib=True ):
   """ Gets scaler object for data scaling
 
@@ -284,17 +472,9 @@ def getNewScaler( mean, scale ):
   return dgbscikit.getNewScaler( mean, scale )
 
 def transform(x_train,scaler):
-  nrattribs = scaler.n_samples_seen_
-  if nrattribs > 0:
-    for iattr in range(nrattribs):
-      if nrattribs == 1:
-        inp = x_train
-      else:
-        inp = x_train[:,iattr]
-      inp -= scaler.mean_[iattr]
-      doscale = np.flatnonzero( scaler.scale_ )
-      if (doscale == iattr)[iattr]:
-        inp /= scaler.scale_[iattr]
+  import dgbpy.dgbscikit as dgbscikit
+  if scaler.n_samples_seen_ > 0:
+    dgbscikit.scale( x_train, scaler )
 
 def getSettingsMltrain(platform, params, settings_mltrain):
   settings_mltrain["lastplatform"] = platform
@@ -432,7 +612,8 @@ def doTrain( examplefilenm, platform=dgbkeys.kerasplfnm, type=TrainType.New,
                                           nbchunks=params['nbchunk'],
                                           force=False,
                                           split=params['split'],nbfolds=params['nbfold'],
-                                          seed=params['userandomseed'] )
+                                          seed=params['userandomseed'],
+                                          streaming=params.get('streaming',False) )
       outfnm, out_infos = getOutFnm( outnm, trainingdp, infos, args )
       hasunlabels = dgbhdf5.hasUnlabeled(dgbmlio.getInfo(examplefilenm))
       if type != TrainType.New and dgbkeys.trainconfigdictstr in infos and hasunlabels:
@@ -522,7 +703,7 @@ def doApplyFromFile( modelfnm, samples, outsubsel=None ):
   applyinfo = dgbmlio.getApplyInfo( info, outsubsel )
   return doApply( model, info, samples, applyinfo=applyinfo )
 
-def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None ):
+def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None, outbuffers=None ):
   """ Applies a trained machine learning model on any platform for any workflow
 
   Parameters:
@@ -532,6 +713,8 @@ def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None )
     * scaler (obj): scaler for scaling if any
     * applyinfo (dict): information from example file to apply model
     * batchsize (int): data batch size
+    * outbuffers (dict): classification output arrays reused from one call to the next
+                         (see dgbpy.mlio.getClassificationResults), the results are copies
 
   Returns:
     * dict: prediction results (reformatted, see dgbpy.mlapply.reformat)
@@ -569,24 +752,24 @@ def doApply( model, info, samples, scaler=None, applyinfo=None, batchsize=None )
   if dgbhdf5.isZipModel(info):
     import dgbpy.zipmodelbase as dgbzipmodel
     res = dgbzipmodel.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
-                        dictinpshape, dictoutshape, nroutputs )
+                        dictinpshape, dictoutshape, nroutputs, out=outbuffers )
   elif platform == dgbkeys.kerasplfnm:
     import dgbpy.dgbkeras as dgbkeras
     
     res = dgbkeras.apply( model, info, samples, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
-                          dictinpshape, scaler=None, batch_size=batchsize  )
+                          dictinpshape, scaler=None, batch_size=batchsize, out=outbuffers  )
   elif platform == dgbkeys.scikitplfnm:
     import dgbpy.dgbscikit as dgbscikit
     res = dgbscikit.apply( model, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities )
   elif platform == dgbkeys.torchplfnm:
     import dgbpy.dgbtorch as dgbtorch
-    res = dgbtorch.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, batchsize )
+    res = dgbtorch.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, batchsize, out=outbuffers )
   elif platform == dgbkeys.numpyvalstr:
     res = numpyApply( samples )
   elif platform == dgbkeys.onnxplfnm:
     import dgbpy.dgbonnx as dgbonnx
     res = dgbonnx.apply( model, info, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, \
-                        dictinpshape, dictoutshape, nroutputs )
+                        dictinpshape, dictoutshape, nroutputs, batchsize, out=outbuffers )
   else:
     log_msg( 'Unsupported machine learning platform' )
     raise AttributeError
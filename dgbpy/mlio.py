@@ -275,6 +275,97 @@ def getTrainingData( filenm, decim=False ):
 
   return getTrainingDataByInfo( infos, dsetsel=dsets )
 
+examplecachestr = 'ML_EXAMPLE_CACHE'
+examplecachedtypestr = 'ML_EXAMPLE_CACHE_DTYPE'
+
+def getExampleCacheDir( filenm ):
+  """ Gets the directory of the memory-mapped example cache
+
+  The cache is opt-in: set ML_EXAMPLE_CACHE to a directory,
+  or to 'Yes' to write the cache files next to the example file.
+
+  Parameters:
+    * filenm (str): path to the example file in hdf5 format
+
+  Returns:
+    * str: cache directory, None if the cache is disabled
+  """
+
+  if not examplecachestr in os.environ:
+    return None
+  cachedir = os.environ[examplecachestr]
+  if cachedir in ('', 'No', 'False', '0'):
+    return None
+  if cachedir in ('Yes', 'True', '1'):
+    return os.path.dirname( os.path.abspath(filenm) )
+  return cachedir
+
+def getExampleCacheKey( filenm, dsetsel, dtype ):
+  import hashlib
+  import json
+  stat = os.stat( filenm )
+  sel = json.dumps( dsetsel, sort_keys=True, default=lambda obj: np.asarray(obj).tolist() )
+  key = '|'.join( (os.path.abspath(filenm), str(stat.st_mtime_ns), str(stat.st_size), dtype, sel) )
+  return hashlib.sha1( key.encode() ).hexdigest()[:16]
+
+def getCachedDatasets( info, dsetsel=None ):
+  """ Gets the examples of a selection through the memory-mapped example cache
+
+  On the first call the examples are read from the example file and written
+  once as contiguous .npy sidecar files, keyed by example file path, mtime and
+  selection. Later calls return memory-mapped views of these files.
+  The views are copy-on-write: in-place changes (class normalization, scaling)
+  are never written back to the cache.
+  Falls back to dgbpy.hdf5.getDatasets when the cache is disabled.
+
+  Parameters:
+    * info (dict): information about example file
+    * dsetsel (dict): selection of examples, all examples if None
+
+  Returns:
+    * dict: train, validation datasets as (memory-mapped) arrays
+  """
+
+  import json
+  filenm = info[dgbkeys.filedictstr]
+  cachedir = getExampleCacheDir( filenm )
+  if cachedir == None or not os.path.isfile( filenm ):
+    return dgbhdf5.getDatasets( info, dsetsel )
+
+  dtype = os.environ.get( examplecachedtypestr, 'float32' )
+  if dtype not in ('float32', 'float16'):
+    dtype = 'float32'
+  seldsets = info[dgbkeys.datasetdictstr] if dsetsel == None else dsetsel
+  key = getExampleCacheKey( filenm, seldsets, dtype )
+  basenm = os.path.join( cachedir, os.path.splitext(os.path.basename(filenm))[0]+'.'+key )
+  indexfnm = basenm + '.json'
+  if os.path.isfile( indexfnm ):
+    try:
+      with open( indexfnm, 'r' ) as file:
+        exnms = json.load( file )
+      return {ex: np.load( f'{basenm}.{ex}.npy', mmap_mode='c' ) for ex in exnms}
+    except (OSError, ValueError):
+      pass
+
+  examples = dgbhdf5.getDatasets( info, dsetsel )
+  try:
+    os.makedirs( cachedir, exist_ok=True )
+    for ex in examples:
+      arr = examples[ex]
+      if ex in (dgbkeys.xtraindictstr, dgbkeys.xvaliddictstr):
+        arr = arr.astype( dtype, copy=False )
+      tmpfnm = f'{basenm}.{ex}.tmp.npy'
+      np.save( tmpfnm, np.ascontiguousarray(arr) )
+      os.replace( tmpfnm, f'{basenm}.{ex}.npy' )
+    with open( indexfnm+'.tmp', 'w' ) as file:
+      json.dump( list(examples.keys()), file )
+    os.replace( indexfnm+'.tmp', indexfnm )
+  except OSError as e:
+    log_msg( 'Cannot write the example cache:', str(e) )
+    return examples
+
+  return {ex: np.load( f'{basenm}.{ex}.npy', mmap_mode='c' ) for ex in examples}
+
 def getTrainingDataByInfo( info, dsetsel=None ):
   """ Gets training data from file info
 
@@ -286,7 +377,7 @@ def getTrainingDataByInfo( info, dsetsel=None ):
     * dict: train, validation datasets as arrays, and info on example file
   """
 
-  examples = dgbhdf5.getDatasets( info, dsetsel )
+  examples = getCachedDatasets( info, dsetsel )
   ret = {}
   for ex in examples:
     ret.update({ex: examples[ex]})
@@ -331,6 +422,116 @@ def unnormalize_class_vector( arr, classes ):
   for i in reversed(range( len(classes) ) ):
     arr[arr == i] = classes[i]
 
+def getClassificationResults( probs, withpred=True, withprobs=[], withconfidence=False, axis=1, out=None ):
+  """ Classification outputs from the probabilities of all classes,
+      computed in a single pass over the classes
+
+  Parameters:
+    * probs (ndarray): probabilities (or scores) of all classes, in float16 or float32
+    * withpred (bool): returns the index of the most likely class
+    * withprobs (list): indices of the classes of which the probabilities are returned
+    * withconfidence (bool): returns the difference between the two highest probabilities
+    * axis (int): axis of the classes in probs
+    * out (dict): output arrays per output key (optional), reused when of the right shape
+                  (and dtype, except for the class index). The arrays allocated otherwise
+                  are stored in it for the next call
+
+  Returns:
+    * dict: class index, selected probabilities and confidence, with the layout of probs
+            (the class axis has size 1 for the class index and confidence)
+  """
+
+  if out is None:
+    out = {}
+  def getOutput( key, shape, dtype, anydtype=False ):
+    res = out.get( key )
+    if not isinstance( res, np.ndarray ) or res.shape != tuple(shape) or \
+       not (anydtype or res.dtype == dtype):
+      res = np.empty( shape, dtype=dtype )
+      out[key] = res
+    return res
+
+  ret = {}
+  outshape = list(probs.shape)
+  outshape[axis] = 1
+  if len(withprobs) > 0:
+    probshape = list(probs.shape)
+    probshape[axis] = len(withprobs)
+    res = getOutput( dgbkeys.probadictstr, probshape, probs.dtype )
+    np.take( probs, withprobs, axis=axis, out=res )
+    ret.update({dgbkeys.probadictstr: res})
+  if not (withpred or withconfidence):
+    return ret
+
+  classprobs = np.moveaxis( probs, axis, 0 )
+  top1 = classprobs[0].copy()
+  top2 = np.full_like( top1, -np.inf )
+  istop = np.empty( top1.shape, dtype=bool )
+  if withpred:
+    res = getOutput( dgbkeys.preddictstr, outshape, np.int64, anydtype=True )
+    ret.update({dgbkeys.preddictstr: res})
+    indices = np.moveaxis( res, axis, 0 )[0]
+    indices.fill( 0 )
+  for iclass in range( 1, len(classprobs) ):
+    classprob = classprobs[iclass]
+    np.greater( classprob, top1, out=istop )
+    np.maximum( top2, classprob, out=top2 )
+    np.copyto( top2, top1, where=istop )
+    np.copyto( top1, classprob, where=istop )
+    if withpred:
+      np.copyto( indices, iclass, where=istop )
+  if withconfidence:
+    res = getOutput( dgbkeys.confdictstr, outshape, probs.dtype )
+    np.subtract( top1, top2, out=np.moveaxis(res, axis, 0)[0] )
+    ret.update({dgbkeys.confdictstr: res})
+  return ret
+
+def getApplyResults( predictions, isclassification, nroutputs, withpred, withprobs, withconfidence, \
+                     doprobabilities, axis=1, img2img=False, keepdims=True, out=None ):
+  """ Apply results of any platform from the model predictions
+
+  Parameters:
+    * predictions (ndarray): model output, with the outputs (classes) along axis
+    * isclassification (bool): classification model
+    * nroutputs (int): number of outputs or classes
+    * withpred, withprobs, withconfidence, doprobabilities: requested outputs
+    * axis (int): axis of the outputs in predictions
+    * img2img (bool): image to image model, otherwise the results of the other
+                      samples are returned with one row per output
+    * keepdims (bool): keep the class axis (of size 1) in the class index
+    * out (dict): reused output arrays (see getClassificationResults)
+
+  Returns:
+    * dict: apply results (labels, probabilities, confidence)
+  """
+
+  ret = {}
+  if not isclassification:
+    if withpred:
+      ret.update({dgbkeys.preddictstr: predictions})
+    return ret
+
+  if not (doprobabilities or withconfidence):
+    if not withpred:
+      return ret
+    if predictions.shape[axis] < 2 or (img2img and nroutputs <= 2):
+      # Image outputs of two classes are returned as continuous values
+      if predictions.shape[axis] == 2:
+        predictions = np.take( predictions, -1, axis=axis )
+      ret.update({dgbkeys.preddictstr: predictions})
+      return ret
+
+  if not doprobabilities:
+    withprobs = []
+  ret = getClassificationResults( predictions, withpred, withprobs, withconfidence, axis, out )
+  if not img2img and axis != 0:
+    for key in ret:
+      ret[key] = np.moveaxis( ret[key], axis, 0 )
+    axis = 0
+  if not keepdims and dgbkeys.preddictstr in ret:
+    ret[dgbkeys.preddictstr] = np.squeeze( ret[dgbkeys.preddictstr], axis=axis )
+  return ret
+
 def saveModel( model, inpfnm, platform, infos, outfnm, params, **kwargs ):
   """ Saves trained model for any platform workflow
 
@@ -402,13 +603,13 @@ def getModel( modelfnm, fortrain=False, pars=None, **kwargs ):
     model = dgbkeras.load( modelfnm, fortrain, infos, pars )
   elif platform == dgbkeys.scikitplfnm:
     import dgbpy.dgbscikit as dgbscikit
-    model = dgbscikit.load( modelfnm )
+    model = dgbscikit.load( modelfnm, pars )
   elif platform == dgbkeys.torchplfnm:
     import dgbpy.dgbtorch as dgbtorch
     model = dgbtorch.load( modelfnm, infos )
   elif platform == dgbkeys.onnxplfnm:
     import dgbpy.dgbonnx as dgbonnx
-    model = dgbonnx.load( modelfnm )
+    model = dgbonnx.load( modelfnm, pars )
   else:
     from odpy.common import log_msg
     log_msg( 'Unsupported machine learning platform' )
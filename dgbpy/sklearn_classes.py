@@ -4,29 +4,43 @@ from joblib import load
 import json
 
 class OnnxScikitModel:
-    def __init__(self, filepath : str):
+    def __init__(self, filepath : str, intra_op_threads=0, inter_op_threads=0):
         self.name = filepath
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self._session = None
 
-    def _do_predict(self,x_data,outidx):
-        if not os.path.exists(str(self.name)):
-            raise FileNotFoundError()
+    @property
+    def session(self):
+        """InferenceSession created on first use, and reused by all predictions"""
+        if self._session is None:
+            if not os.path.exists(str(self.name)):
+                raise FileNotFoundError()
 
-        import onnxruntime as rt
-        import numpy as np
-        sess = rt.InferenceSession(self.name)
+            import onnxruntime as rt
+            opts = rt.SessionOptions()
+            opts.intra_op_num_threads = int(self.intra_op_threads)
+            opts.inter_op_num_threads = int(self.inter_op_threads)
+            self._session = rt.InferenceSession(self.name, opts)
+        return self._session
+
+    def _do_predict(self,x_data,outidxs):
+        sess = self.session
         input_name = sess.get_inputs()[0].name
-        label_name = sess.get_outputs()[outidx].name
-        runopts = rt.RunOptions()
-        pred_onx = sess.run([label_name],
-                            {input_name: x_data.astype(np.single)},
-                            run_options=runopts)[0]
-        return np.squeeze( pred_onx )
+        outputs = sess.get_outputs()
+        pred_onx = sess.run([outputs[outidx].name for outidx in outidxs],
+                            {input_name: x_data.astype(np.single, copy=False)})
+        return [np.squeeze( pred ) for pred in pred_onx]
 
     def predict(self,x_data):
-        return self._do_predict(x_data,0)
+        return self._do_predict(x_data,[0])[0]
 
     def predict_proba(self,x_data):
-        return self._do_predict(x_data,1)
+        return self._do_predict(x_data,[1])[0]
+
+    def predict_with_proba(self,x_data):
+        """Labels and probabilities from a single run"""
+        return tuple( self._do_predict(x_data,[0,1]) )
 
 def model_info( modelfnm ):
     model = load( modelfnm )
@@ -16,7 +16,7 @@ import math
 import torch
 import numpy as np
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torch.nn import Linear, ReLU, Sequential, Conv1d, Conv2d, Conv3d, Dropout, Dropout2d, Dropout3d
 from torch.nn import MaxPool1d, MaxPool2d, MaxPool3d, Softmax, BatchNorm1d, BatchNorm2d, BatchNorm3d
 from torch.optim.lr_scheduler import _LRScheduler
@@ -694,7 +694,7 @@ class Trainer:
                 self('before_fit_chunk')
                 if not self.train_dl.set_chunk(ichunk) or not self.valid_dl.set_chunk(ichunk):
                     continue
-                if self.train_dl.batch_size > len(self.train_dl):
+                if self.train_dl.get_batchsize() > len(self.train_dl):
                     raise Exception('Batch size is too high for the available data')
             except Exception as e:
                 odcommon.log_msg('')
@@ -1382,7 +1382,52 @@ class UNet_VGG19(nn.Module):
         return conv8
 
 
-class TrainDatasetClass(Dataset):
+def adaptChunkShape(X, Y, ndims):
+    """
+        Views of the chunk arrays with the shape expected by the network.
+        Computed once per chunk, instead of once per sample.
+    """
+    if ndims == 3:
+        return X, Y
+    if ndims == 2:
+        index = (slice(None), slice(None), 0)
+    else:
+        index = (slice(None), slice(None), 0, 0)
+    if len(Y.shape) == len(X.shape):
+        return X[index], Y[index]
+    return X[index], Y
+
+class SharedChunkMixin:
+    """
+        Places the chunk arrays in shared memory, so that DataLoader workers
+        receive a handle to them instead of a pickled copy of the chunk
+    """
+    sharememory = False
+
+    def share_chunk(self):
+        if not self.sharememory:
+            return
+        self.Xt = torch.from_numpy(self.X).share_memory_()
+        self.yt = torch.from_numpy(self.y).share_memory_()
+        self.X, self.y = self.Xt.numpy(), self.yt.numpy()
+        self.Xv, self.yv = adaptChunkShape(self.X, self.y, self.ndims)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('imgdp', None)
+        state['prefetcher'] = None
+        if 'Xt' in state:
+            for key in ('X', 'y', 'Xv', 'yv'):
+                state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'Xt' in state:
+            self.X, self.y = self.Xt.numpy(), self.yt.numpy()
+            self.Xv, self.yv = adaptChunkShape(self.X, self.y, self.ndims)
+
+class TrainDatasetClass(SharedChunkMixin, Dataset):
     def __init__(self, imgdp, scale, transform=list(), transform_copy = False):
         """
         Details:
@@ -1401,6 +1446,7 @@ class TrainDatasetClass(Dataset):
         self.transformer = False
         self.transform_seed = dgbhdf5.getSeed(imgdp[dgbkeys.infodictstr])
         self.trfm_copy = transform_copy
+        self.prefetcher = None
 
     def __len__(self):
         return len(self._data_IDs)
@@ -1410,7 +1456,10 @@ class TrainDatasetClass(Dataset):
         Details:
             idx : Index of the sample to be retrieved.
                     - using the expected multiplied number of samples by the trfm_multiplier
+                  A batch of indices is retrieved at once when used with a BatchSampler.
         """
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self.get_batch(idx)
         sample, transform_idx = np.divmod(idx, len(self.trfm_multiplier))
         if self.ndims < 2:
             X, Y = self._adaptShape(self.X[sample], self.y[sample])
@@ -1424,6 +1473,19 @@ class TrainDatasetClass(Dataset):
             X, Y = self._adaptShape(X, Y)
             return X, Y
 
+    def get_batch(self, idxs):
+        """
+        Details:
+            idxs : Indices of a batch of samples, as provided by a BatchSampler.
+                    Without augmentation the batch is a single slice of the chunk arrays.
+        """
+        idxs = np.asarray(idxs)
+        samples, transform_idxs = np.divmod(idxs, len(self.trfm_multiplier))
+        if self.ndims < 2 or not self.transformer or len(self.transformer.transforms) == 0:
+            return self.Xv[samples], self.yv[samples]
+        X, Y = self.transformer.transform_batch(self.X[samples], self.y[samples], idxs, transform_idxs=transform_idxs)
+        return adaptChunkShape(X, Y, self.ndims)
+
     def set_chunk(self, ichunk):
         """
             Set the chunk to be used for training
@@ -1440,10 +1502,13 @@ class TrainDatasetClass(Dataset):
             Set the fold for a particular chunk to be used for training
         """
         from dgbpy import mlapply as dgbmlapply
-        trainchunk  = dgbmlapply.getScaledTrainingDataByInfo( self.info,
+        if self.prefetcher:
+            trainchunk = self.prefetcher.get(ichunk, ifold)
+        else:
+            trainchunk  = dgbmlapply.getScaledTrainingDataByInfo( self.info,
                                                 flatten=False,
                                                 scale=self.isDefScaler, ichunk=ichunk, ifold=ifold)
-        return self.get_data(trainchunk, ichunk)
+        return self.get_data(trainchunk, ichunk, copy=False)
 
     def set_transform_seed(self):
         """
@@ -1453,14 +1518,17 @@ class TrainDatasetClass(Dataset):
             self.transform_seed+=1
         self.transformer.set_uniform_generator_seed(self.transform_seed, len(self))
 
-    def get_data(self, trainchunk, ichunk):
+    def get_data(self, trainchunk, ichunk, copy=True):
         """
-            Get the data from the chunk
+            Get the data from the chunk. Chunks loaded for this dataset only
+            (copy=False) are used as is when already of type float32.
         """
         from dgbpy import dgbtorch
         X, y, info, im_ch, self.ndims = dgbtorch.getDatasetPars(trainchunk, False)
-        self.X = X.astype('float32')
-        self.y = y.astype('float32')
+        self.X = X.astype('float32', copy=copy)
+        self.y = y.astype('float32', copy=copy)
+        self.Xv, self.yv = adaptChunkShape(self.X, self.y, self.ndims)
+        self.share_chunk()
 
         if ichunk == 0: # initialise transforms on first chunk only
             self.set_transforms(info)
@@ -1530,11 +1598,12 @@ class TrainDatasetClass(Dataset):
             return X[:, 0, 0, :], Y[:]
         return data, label
 
-class TestDatasetClass(Dataset):
+class TestDatasetClass(SharedChunkMixin, Dataset):
     def __init__(self, imgdp, scale):
         self.imgdp = imgdp
         self.scale, self.isDefScaler=dgbhdf5.isDefaultScaler(scale, imgdp[dgbkeys.infodictstr])
         self.transform = []
+        self.prefetcher = None
 
     def __len__(self):
         return self.X.shape[0]
@@ -1554,24 +1623,36 @@ class TestDatasetClass(Dataset):
 
     def set_fold(self, ichunk, ifold):
         from dgbpy import mlapply as dgbmlapply
-        validchunk  = dgbmlapply.getScaledTrainingDataByInfo( self.info,
+        if self.prefetcher:
+            validchunk = self.prefetcher.get(ichunk, ifold)
+        else:
+            validchunk  = dgbmlapply.getScaledTrainingDataByInfo( self.info,
                                                 flatten=False,
                                                 scale=True, ichunk=ichunk, ifold=ifold)
-        return self.get_data(validchunk, ichunk)
+        return self.get_data(validchunk, ichunk, copy=False)
 
-    def get_data(self, validchunk, ichunk):
+    def get_data(self, validchunk, ichunk, copy=True):
         from dgbpy import dgbtorch
         from dgbpy import transforms as T
         X, y, info, im_ch, self.ndims = dgbtorch.getDatasetPars(validchunk, True)
-        self.X = X.astype('float32')
-        self.y = y.astype('float32')
+        self.X = X.astype('float32', copy=copy)
+        self.y = y.astype('float32', copy=copy)
+        self.Xv, self.yv = adaptChunkShape(self.X, self.y, self.ndims)
+        self.share_chunk()
 
         if ichunk == 0:
             if not self.isDefScaler:
                 self.transform = T.TransformCompose(self.scale, info, self.ndims)
         return True
 
+    def get_batch(self, indices):
+        if not self.transform:
+            return self.Xv[indices], self.yv[indices]
+        return self.transform.transform_batch(self.Xv[indices], self.yv[indices], indices)
+
     def __getitem__(self,index):
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.get_batch(index)
         classification = self.info[dgbkeys.classdictstr]
         if self.ndims == 3:
             if len(self.X.shape)==len(self.y.shape) and len(self.X.shape)==5 and classification:   #segmentation
@@ -1622,12 +1703,191 @@ class TestDatasetClass(Dataset):
 
         return self.transformer(data, label, index)
 
+class StreamingDatasetClass(IterableDataset):
+    def __init__(self, imgdp, scale, transform=list(), forvalid=False, blocksize=1024, readahead=2):
+        """
+        Details:
+            imgdp : HDF5 Dataset, only its info is used. The examples are read
+                    lazily from the example file, one block at a time.
+            scale : Type of scaling to be applied to the data
+            transform : List of transforms to be applied to the training data
+            forvalid : If True, iterates over the validation examples of the chunk
+            blocksize : Number of examples read from the example file at once
+            readahead : Maximum number of blocks held in the read-ahead buffer
+        """
+        from dgbpy import dgbtorch
+        self.imgdp = imgdp
+        self.info = imgdp[dgbkeys.infodictstr]
+        self.scale, self.isDefScaler = dgbhdf5.isDefaultScaler(scale, self.info)
+        self.transform = [] if forvalid else dgbkeys.listify(transform)
+        self.transformer = False
+        self.transform_seed = dgbhdf5.getSeed(self.info)
+        # Shared by the DataLoader workers, that get a copy of the dataset at each epoch
+        self.shuffle_seed = self.transform_seed if self.transform_seed is not None else np.random.randint(2**31)
+        self.epoch = 0
+        self.forvalid = forvalid
+        self.blocksize = max(1, int(blocksize))
+        self.readahead = max(1, int(readahead))
+        self.blocks = []
+        self.nrsamples = 0
+        attribs = dgbhdf5.getNrAttribs(self.info)
+        model_shape = dgbtorch.get_model_shape(self.info[dgbkeys.inpshapedictstr], attribs, True)
+        self.ndims = dgbtorch.getModelDims(model_shape, True)
+
+    def __len__(self):
+        return self.nrsamples
+
+    def set_chunk(self, ichunk):
+        """
+            Set the chunk to be used for training
+        """
+        self.info = self.imgdp[dgbkeys.infodictstr]
+        return self.set_fold(ichunk, 1)
+
+    def set_fold(self, ichunk, ifold):
+        """
+            Set the fold for a particular chunk, only the example selection is kept in memory
+        """
+        if ifold and dgbhdf5.isCrossValidation(self.info):
+            datasets = self.info[dgbkeys.trainseldicstr][ichunk][dgbkeys.foldstr+f'{ifold}']
+        else:
+            datasets = self.info[dgbkeys.trainseldicstr][ichunk]
+        if self.forvalid:
+            dsets = datasets[dgbkeys.validdictstr] if dgbkeys.validdictstr in datasets else {}
+        else:
+            dsets = datasets[dgbkeys.traindictstr] if dgbkeys.traindictstr in datasets else datasets
+        self.set_blocks(dsets)
+        if ichunk == 0 and not self.transformer:
+            self.set_transforms()
+        return True
+
+    def set_blocks(self, dsets):
+        """
+            Splits the sorted example selection into blocks of contiguous examples
+        """
+        self.blocks = []
+        self.nrsamples = 0
+        for groupnm in dsets:
+            for block in dgbhdf5.getCubeLetBlocks(self.info, dsets[groupnm], self.blocksize):
+                self.blocks.append((groupnm, block))
+                self.nrsamples += len(next(iter(block.values())))
+
+    def set_transforms(self):
+        """
+            Set the transforms to be applied to the data
+        """
+        from dgbpy import transforms as T
+        transforms = list(self.transform)
+        if not self.isDefScaler:
+            transforms.append(self.scale)
+        if len(transforms) > 0:
+            self.transformer = T.TransformCompose(transforms, self.info, self.ndims)
+
+    def set_transform_seed(self):
+        """
+            Set different seed for each epoch
+        """
+        self.epoch += 1
+        if not self.transformer:
+            return
+        if self.transform_seed:
+            self.transform_seed+=1
+        self.transformer.set_uniform_generator_seed(self.transform_seed, len(self))
+
+    def read_block(self, block):
+        """
+            Reads, normalizes and scales one block of examples from the example file
+        """
+        from dgbpy import mlapply as dgbmlapply
+        from dgbpy import mlio as dgbmlio
+        groupnm, collection = block
+        cubelets = dgbhdf5.getCubeLets(self.info, collection, groupnm)
+        if len(cubelets) < 1:
+            return None
+        X = cubelets[dgbkeys.xtraindictstr]
+        y = cubelets[dgbkeys.ytraindictstr]
+        if self.info[dgbkeys.classdictstr]:
+            dgbmlio.normalize_class_vector(y, self.info[dgbkeys.classesdictstr])
+        inputs = self.info[dgbkeys.inputdictstr]
+        if (self.forvalid or self.isDefScaler) and groupnm in inputs and dgbkeys.scaledictstr in inputs[groupnm]:
+            dgbmlapply.transform(X, inputs[groupnm][dgbkeys.scaledictstr])
+        return X.astype('float32', copy=False), y.astype('float32', copy=False)
+
+    def __iter__(self):
+        """
+            Yields the samples block by block. The blocks are read ahead by a background
+            thread into a bounded buffer; the block order and the sample order within
+            each block are shuffled for training, from a seed that changes every epoch.
+            The order and the transform index of each sample (its position in the epoch)
+            do not depend on the number of DataLoader workers.
+        """
+        import queue, threading
+        from torch.utils.data import get_worker_info
+        shuffler = np.random.RandomState(seed=(self.shuffle_seed+self.epoch) % 2**32)
+        if self.forvalid:
+            order = np.arange(len(self.blocks))
+        else:
+            order = shuffler.permutation(len(self.blocks))
+        blocksizes = [len(next(iter(self.blocks[iblock][1].values()))) for iblock in order]
+        offsets = np.cumsum([0]+blocksizes[:-1], dtype=int)
+        rowseeds = shuffler.randint(2**31, size=len(order))
+        blocks = list(zip(order, offsets, rowseeds))
+        worker = get_worker_info()
+        if worker is not None:
+            blocks = blocks[worker.id::worker.num_workers]
+
+        buffer = queue.Queue(maxsize=self.readahead)
+        done = object()
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def reader():
+            try:
+                for iblock, offset, rowseed in blocks:
+                    data = self.read_block(self.blocks[iblock])
+                    if data is not None and not put((offset, rowseed, data)):
+                        return
+            except Exception as e:
+                put(e)
+            put(done)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                data = buffer.get()
+                if data is done:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                isample, rowseed, (X, y) = data
+                rows = np.arange(len(X)) if self.forvalid else np.random.RandomState(seed=rowseed).permutation(len(X))
+                X, y = self.get_samples(X[rows], y[rows], np.arange(isample, isample+len(rows)) % max(1, len(self)))
+                for irow in range(len(rows)):
+                    yield TrainDatasetClass._adaptShape(self, X[irow], y[irow])
+        finally:
+            stop.set()
+            thread.join()
+
+    def get_samples(self, X, Y, idxs):
+        if self.transformer:
+            X, Y = self.transformer.transform_batch(X, Y, idxs)
+        return X, Y
+
 class DatasetApply(Dataset):
     def __init__(self, X, info, isclassification, im_ch, ndims):
         super().__init__()
         self.im_ch = im_ch
         self.ndims = ndims
-        self.X = X.astype('float32')
+        self.X = X.astype('float32', copy=False)
         self.isclassification = isclassification
 
     def __len__(self):
@@ -1641,6 +1901,16 @@ class DatasetApply(Dataset):
         elif self.ndims == 1:
             return self.X[index, :, 0, 0, :]
 
+    def get_batch(self, start, stop, size=None):
+        """Samples start to stop as a tensor sharing the memory of the input array,
+           or zero padded to size samples (new tensor) for a static batch shape"""
+        batch = torch.from_numpy(self[start:stop])
+        if size is None or len(batch) >= size:
+            return batch
+        padded = batch.new_zeros((size,)+batch.shape[1:])
+        padded[:len(batch)] = batch
+        return padded
+
 import importlib
 import pkgutil
 import inspect
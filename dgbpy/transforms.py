@@ -72,6 +72,34 @@ class BaseTransform(ABC):
                 label = self.transform(label)
         return image, label
 
+    def batch_pars(self, nsamples):
+        """
+            Draws the random parameters of the transform for a batch of nsamples samples.
+            The same parameters are used for the images and their labels.
+        """
+        pass
+
+    def transform_batch(self, arr):
+        """
+            Returns the transformed batch of samples, with the samples along the first axis.
+            Transforms without a vectorized implementation are applied sample by sample.
+        """
+        return np.stack([self.transform(sample) for sample in arr])
+
+    def apply_batch(self, image, label, mask, **kwargs):
+        """
+            Applies the transform in place to the samples of a batch selected by mask.
+        """
+        self.ndims = kwargs.get(dgbkeys.ndimstr, None)
+        self.create_copy = kwargs.get('create_copy', False)
+        sel = np.flatnonzero(mask)
+        if len(sel) < 1:
+            return
+        self.batch_pars(len(sel))
+        image[sel] = self.transform_batch(image[sel])
+        if self.do_label_transform:
+            label[sel] = self.transform_batch(label[sel])
+
 
 
 class Flip(BaseTransform):
@@ -107,6 +135,28 @@ class Flip(BaseTransform):
             self.transform_pars(arr_shape)
             return np.rot90(arr,self.aug_axis,self.aug_dims).copy()
 
+    def batch_pars(self, nsamples):
+        self.batch_axes = np.full(nsamples, 2)
+        if self.ndims != 3:
+            return
+        cubesz = self.aug_shape
+        if len(cubesz) == 2 and cubesz[0] == cubesz[1]:
+            self.batch_axes = (self.mult_count + 1 + np.arange(nsamples)) % 3
+            self.mult_count += nsamples
+
+    def transform_batch(self, arr):
+        if self.ndims == 2:
+            return np.flip(arr, axis=2)
+        out = np.empty_like(arr)
+        for aug_axis in np.unique(self.batch_axes):
+            sel = self.batch_axes == aug_axis
+            out[sel] = np.rot90(arr[sel], aug_axis, (2, 3))
+        return out
+
+    def apply_batch(self, image, label, mask, **kwargs):
+        self.aug_shape = image.shape[3:5]
+        super().apply_batch(image, label, mask, **kwargs)
+
 class GaussianNoise(BaseTransform):
     def __init__(self, p=0.2, std=0.1):
         super().__init__()
@@ -121,6 +171,9 @@ class GaussianNoise(BaseTransform):
         noise = np.random.normal(loc = 0, scale = self.std, size = arr.shape).astype('float32')
         return arr + noise
 
+    def transform_batch(self, arr):
+        return self.transform(arr)
+
 def hasOpenCV():
   try:
     import cv2
@@ -147,6 +200,13 @@ class Rotate(BaseTransform):
             return self.transform_2d(arr, angle)
         return self.transform_3d(arr, angle)
     
+    def batch_pars(self, nsamples):
+        self.batch_angles = np.random.choice(range(-self.angle, self.angle), size=nsamples)
+
+    def transform_batch(self, arr):
+        transform_fn = self.transform_2d if self.ndims == 2 else self.transform_3d
+        return np.stack([transform_fn(sample, angle) for sample, angle in zip(arr, self.batch_angles)])
+
     def transform_2d(self, arr, angle):
         center = ( (arr.shape[-1])//2, (arr.shape[-2])//2 )
         dst_image = (arr.shape[-1], arr.shape[-2])
@@ -190,6 +250,14 @@ class Translate(BaseTransform):
             transform_axes = (0, *ax)
         return self.shift(arr, transform_axes)
 
+    def transform_batch(self, arr):
+        if self.ndims not in (2, 3):
+            return super().transform_batch(arr)
+        ax = arr.shape[3:] if self.ndims == 2 else arr.shape[2:]
+        ax = map(lambda x: int(x*self.percent), ax)
+        transform_axes = (0, 0, 0, *ax) if self.ndims == 2 else (0, 0, *ax)
+        return self.shift(arr, transform_axes)
+
 class FlipPolarity(BaseTransform):
     def __init__(self, p = 0.2):
         """
@@ -217,6 +285,9 @@ class FlipPolarity(BaseTransform):
         transfomed_arr = arr * -1.0
         return transfomed_arr
 
+    def transform_batch(self, arr):
+        return self.transform(arr)
+
 
 
 class ScaleTransform(BaseTransform):
@@ -408,6 +479,47 @@ class TransformCompose():
             image, label = transform_i(image=image, label=label, ndims=self.ndims, create_copy=self.create_copy)
         return image, label
 
+    def batch_probs(self, transform_idxs):
+        """
+            Returns the probability of each transform for each sample of a batch with the copy method,
+            as an array of shape (number of transforms, number of samples).
+        """
+        ntransforms = len(self.transforms)
+        probs = np.zeros((ntransforms, len(transform_idxs)))
+        for isample, transform_idx in enumerate(transform_idxs):
+            copy_prob = self.copy_config(transform_idx)
+            probs[:, isample] = copy_prob[:ntransforms]
+        return probs
+
+    def transform_batch(self, images, labels, prob_idxs, transform_idxs = None):
+        """
+            Applies all the transforms to a batch of data, with the samples along the first axis.
+            Each sample receives the same transforms as when calling on each sample separately,
+            but each transform is applied once to all the selected samples of the batch.
+
+            Args:
+                images: batch of samples, modified in place
+                labels: batch of labels, modified in place
+                prob_idxs: indices of the samples used to choose the uniform probability when using seed
+                transform_idxs: values to be used for mixed transforms
+        """
+        nsamples = len(images)
+        prob_idxs = np.asarray(prob_idxs)
+        if transform_idxs is None:
+            transform_idxs = np.zeros(nsamples, dtype=int)
+        probs = self.batch_probs(transform_idxs) if self.create_copy else None
+        for tr_label, transform_i in enumerate(self.transforms):
+            p = transform_i.p
+            if hasattr(transform_i, 'p') and probs is not None:
+                p = probs[tr_label]
+            if self.use_seed:
+                uniform_prob = transform_i.all_uniform_prob[prob_idxs]
+            else:
+                uniform_prob = np.full(nsamples, transform_i.uniform_prob)
+            mask = p > uniform_prob
+            transform_i.apply_batch(images, labels, mask, ndims=self.ndims, create_copy=self.create_copy)
+        return images, labels
+
 
 class TransformMultiplier:
     """
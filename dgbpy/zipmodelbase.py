@@ -18,6 +18,7 @@ else:
 import dgbpy.keystr as dgbkeys
 import dgbpy.hdf5 as dgbhdf5
 import odpy.hdf5 as odhdf5
+from dgbpy.mlio import getApplyResults
 
 
 class PlatformType(StrEnum):
@@ -184,54 +185,11 @@ def load(modelfnm: str):
         h5file.close()
     return model
 
-def apply( model, infos, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, dictinpshape, dictoutshape, nroutputs ):
-    ret = {}
-    res = None
+def apply( model, infos, samples, scaler, isclassification, withpred, withprobs, withconfidence, doprobabilities, dictinpshape, dictoutshape, nroutputs, out=None ):
     img2img = dgbhdf5.isImg2Img(infos)
     nroutputs = dgbhdf5.getNrOutputs(infos)
 
-    predictions = []
     predictions = model.predict(samples)
-    if withpred:
-        if isclassification:
-            if not (doprobabilities or withconfidence):
-                if nroutputs > 2:
-                    predictions = np.argmax(predictions, axis=1)
-                if nroutputs == 2:
-                    predictions = predictions[:, -1]
-
-        if not isinstance(res, np.ndarray):
-            res = predictions
-            ret.update({dgbkeys.preddictstr: res})
-
-    if isclassification and (doprobabilities or withconfidence or withpred):
-        if len(ret)<1:
-            allprobs = (np.array(predictions)).transpose()
-        else:
-            allprobs = ret[dgbkeys.preddictstr]
-        indices = None
-        if withconfidence or not img2img or (img2img and nroutputs>2):
-            N = 2
-            if img2img:
-                indices = np.argpartition(allprobs,-N,axis=1)[:,-N:]
-            else:
-                indices = np.argpartition(allprobs,-N,axis=0)[-N:]
-        if withpred and isinstance( indices, np.ndarray ):
-            if img2img:
-                ret.update({dgbkeys.preddictstr: indices[:,-1:]})
-            else:
-                ret.update({dgbkeys.preddictstr: indices[-1:]})
-        if doprobabilities and len(withprobs) > 0:
-            res = np.copy(allprobs[withprobs])
-            ret.update({dgbkeys.probadictstr: res})
-        if withconfidence:
-            N = 2
-            predictions = np.array(predictions)
-            x = predictions.shape[0]
-            indices = np.argpartition(predictions.transpose(),-N,axis=0)[-N:].transpose()
-            sortedprobs = predictions.transpose()[indices.ravel(),np.tile(np.arange(x),N)].reshape(N,x)
-            res = np.diff(sortedprobs,axis=0)
-            ret.update({dgbkeys.confdictstr: res})
-
-    return ret
+    return getApplyResults(predictions, isclassification, nroutputs, withpred, withprobs, withconfidence,
+                           doprobabilities, axis=1, img2img=img2img, keepdims=False, out=out)
 
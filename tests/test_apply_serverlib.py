@@ -0,0 +1,431 @@
+import sys
+sys.path.insert(0, '..')
+
+import json, os, socket, struct, subprocess, time
+import pytest
+import numpy as np
+import dgbpy.keystr as dbk
+import dgbpy.hdf5 as dgbhdf5
+import dgbpy.deeplearning_apply_serverlib as applylib
+from init_data import *
+
+
+class RequestStub:
+    def __init__(self, arrays):
+        self.request = {'action': 'apply', 'data': arrays}
+        self.result = None
+        self.resumed = False
+
+    def resume(self):
+        self.resumed = True
+
+
+class ApplierStub:
+    """Applier returning the probabilities of withprobs with one row per class"""
+    def __init__(self, withprobs, platform=dbk.torchplfnm):
+        self.withprobs = withprobs
+        self.info_ = {
+            dbk.learntypedictstr: dbk.loglogtypestr,
+            dbk.classdictstr: True,
+            dbk.plfdictstr: platform,
+            dbk.savetypedictstr: 'hdf5',
+        }
+        self.calls = []
+
+    def prepareWork(self, arr):
+        return (arr, arr, arr.shape)
+
+    def isFlatApply(self):
+        return False
+
+    def applySamples(self, samples):
+        self.calls.append(len(samples))
+        probs = np.stack([samples[:, 0]*(iprob+1) for iprob in self.withprobs])
+        return {dbk.preddictstr: samples[:, 0].astype(np.int64), dbk.probadictstr: probs}
+
+    def getSamplesAxis(self, key, arr):
+        return applylib.ModelApplier.getSamplesAxis(self, key, arr)
+
+    def getState(self):
+        return None
+
+    def setState(self, state):
+        pass
+
+    def finishWork(self, ret):
+        return [ret[dbk.preddictstr], ret[dbk.probadictstr]]
+
+
+def test_batch_scheduler_splits_single_sample_requests_along_samples():
+    nrrequests = 2
+    applier = ApplierStub(withprobs=list(range(nrrequests)))
+    scheduler = applylib.BatchScheduler(applier, maxsamples=nrrequests)
+    messages = [RequestStub([np.full((1, 3), ireq+1, dtype=np.float32)]) for ireq in range(nrrequests)]
+    for message in messages:
+        scheduler.add(message)
+    assert scheduler.ready()
+    scheduler.flush()
+
+    assert applier.calls == [nrrequests], 'the requests should be applied in a single batch'
+    for ireq, message in enumerate(messages):
+        assert message.resumed
+        (pred, probs) = message.result
+        assert probs.shape == (nrrequests, 1)
+        expected = [(ireq+1)*(iprob+1) for iprob in range(nrrequests)]
+        assert np.array_equal(probs[:, 0], expected), 'each request should get its own sample'
+        assert np.array_equal(pred, [ireq+1])
+
+
+def test_message_rejects_invalid_payload_length():
+    import selectors
+    for payload_len in (-1, 0, applylib.minpayloadsize-1, applylib.maxpayloadsize+1):
+        sel = selectors.DefaultSelector()
+        (serversock, clientsock) = socket.socketpair()
+        sel.register(serversock, selectors.EVENT_READ)
+        message = applylib.Message(sel, serversock, 'test', None)
+        sel.modify(serversock, selectors.EVENT_READ, data=message)
+        clientsock.sendall(struct.pack('=iih', payload_len, 1, 0))
+        message.read()
+        assert message.sock is None, 'the connection should be closed'
+        assert message._payload is None
+        clientsock.close()
+        sel.close()
+
+
+def test_message_rejects_json_header_beyond_payload():
+    import selectors
+    sel = selectors.DefaultSelector()
+    (serversock, clientsock) = socket.socketpair()
+    sel.register(serversock, selectors.EVENT_READ)
+    message = applylib.Message(sel, serversock, 'test', None)
+    sel.modify(serversock, selectors.EVENT_READ, data=message)
+    clientsock.sendall(struct.pack('=iih', 4, 1, 0) + struct.pack('=i', 100))
+    with pytest.raises(ValueError):
+        message.read()
+    message.close()
+    clientsock.close()
+    sel.close()
+
+
+class TransportStub:
+    def __init__(self):
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return 'test'
+
+    def close(self):
+        self.closed = True
+
+
+def test_apply_protocol_rejects_invalid_payload_length():
+    for payload_len in (-1, 0, applylib.minpayloadsize-1, applylib.maxpayloadsize+1):
+        protocol = applylib.ApplyProtocol(server=None)
+        transport = TransportStub()
+        protocol.connection_made(transport)
+        header = struct.pack('=iih', payload_len, 1, 0)
+        protocol.get_buffer(len(header))[:len(header)] = header
+        protocol.buffer_updated(len(header))
+        assert transport.closed, 'the connection should be closed'
+        assert protocol._payload is None
+
+
+def encode_message(content, reqid=1, subid=0, **jsonheader):
+    """OD header and payload of a request, as sent by the apply client"""
+    jsonheader = json.dumps({
+        'byteorder': sys.byteorder,
+        'content-length': len(content),
+        **jsonheader,
+    }).encode('utf-8')
+    payload = struct.pack('=i', len(jsonheader)) + jsonheader + content
+    return struct.pack('=iih', len(payload), reqid, subid) + payload
+
+def encode_request(content, reqid=1, subid=0):
+    content = json.dumps(content).encode('utf-8')
+    return encode_message(struct.pack('=i', len(content)) + content, reqid, subid,
+                          **{'content-type': 'text/json', 'content-encoding': 'utf-8'})
+
+def encode_array_request(arrs, reqid=1, subid=0):
+    return encode_message(b''.join(arr.tobytes() for arr in arrs), reqid, subid,
+                          **{'content-type': 'binary/array',
+                             'content-encoding': [arr.dtype.name for arr in arrs],
+                             'array-shape': [arr.shape for arr in arrs]})
+
+def recv_exactly(sock, nbytes):
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes-len(data))
+        if not chunk:
+            raise ConnectionError('connection closed by the server')
+        data += chunk
+    return bytes(data)
+
+def read_response(sock):
+    """Request id, JSON header and content of a response"""
+    (payload_len, reqid, subid) = struct.unpack('=iih', recv_exactly(sock, 10))
+    payload = recv_exactly(sock, payload_len)
+    hdrlen = struct.unpack('=i', payload[:4])[0]
+    jsonheader = json.loads(payload[4:4+hdrlen])
+    return reqid, jsonheader, payload[4+hdrlen:]
+
+def decode_json_content(content):
+    return json.loads(content[4:])
+
+def decode_array_content(jsonheader, content):
+    arrs = []
+    offset = 0
+    for shape, dtype in zip(jsonheader['array-shape'], jsonheader['content-encoding']):
+        arr = np.frombuffer(content, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+        arrs.append(arr.reshape(shape))
+        offset += arr.nbytes
+    return arrs
+
+def pop_responses(buffer):
+    """Complete responses at the start of the buffer, removed from it"""
+    responses = []
+    while len(buffer) >= 10:
+        payload_len = struct.unpack('=i', buffer[:4])[0]
+        if len(buffer) < 10+payload_len:
+            break
+        reqid = struct.unpack('=i', buffer[4:8])[0]
+        payload = bytes(buffer[10:10+payload_len])
+        del buffer[:10+payload_len]
+        hdrlen = struct.unpack('=i', payload[:4])[0]
+        responses.append((reqid, json.loads(payload[4:4+hdrlen]), payload[4+hdrlen:]))
+    return responses
+
+def exchange(sel, clientsock, data, nrresponses, timeout=10):
+    """Sends the requests to a Message of the selector, and serves them until nrresponses are received"""
+    clientsock.sendall(data)
+    clientsock.setblocking(False)
+    buffer = bytearray()
+    responses = []
+    deadline = time.monotonic()+timeout
+    while len(responses) < nrresponses and time.monotonic() < deadline:
+        for key, mask in sel.select(timeout=0.05):
+            key.data.process_events(mask)
+        try:
+            received = clientsock.recv(1 << 20)
+        except BlockingIOError:
+            continue
+        if not received:
+            break
+        buffer += received
+        responses += pop_responses(buffer)
+    return responses
+
+class EchoApplierStub:
+    """Applier returning twice its input"""
+    debugstr = ''
+
+    def doWork(self, arr):
+        return [2*arr]
+
+def open_loopback(sock=None, **kwargs):
+    """Server Message registered on one end of a socket pair, and the client end"""
+    import selectors
+    sel = selectors.DefaultSelector()
+    (serversock, clientsock) = socket.socketpair()
+    if sock:
+        serversock = sock(serversock)
+    message = applylib.Message(sel, serversock, 'test', EchoApplierStub(), **kwargs)
+    sel.register(serversock, selectors.EVENT_READ, data=message)
+    return sel, message, clientsock
+
+def save_torch_model(filename):
+    from test_dgbtorch import default_pars, train_model, save_model
+    data = get_loglog_data()
+    model, info = train_model(default_pars(), data)
+    save_model(model, filename, info, default_pars())
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def send_request(port, content):
+    for _ in range(100):
+        try:
+            sock = socket.create_connection(('localhost', port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    with sock:
+        sock.sendall(encode_request(content))
+        return decode_json_content(read_response(sock)[2])
+
+def test_server_workers_stop_together(tmp_path):
+    import psutil
+    modelfnm = str(tmp_path / 'torchmodel.h5')
+    save_torch_model(modelfnm)
+    port = get_free_port()
+    script = os.path.join(os.path.dirname(applylib.__file__), 'deeplearning_apply-server.py')
+    server = subprocess.Popen([sys.executable, script, modelfnm, '--port', str(port),
+                               '--workers', '2', '--fakeapply'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        pids = {send_request(port, {'action': 'status'})['pid'] for _ in range(20)}
+        send_request(port, {'action': 'kill'})
+        output = server.communicate(timeout=60)[0]
+    finally:
+        if server.poll() is None:
+            server.kill()
+    assert server.returncode == 0
+    assert 'Found dead parent' not in output, 'the pool shutdown is not a dead parent'
+    for pid in pids:
+        assert not psutil.pid_exists(pid) or psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+
+
+class WindowApplierStub:
+    getWindows = applylib.ModelApplier.getWindows
+    scaleWindows = applylib.ModelApplier.scaleWindows
+
+    def __init__(self, is2dinp, scaler=None):
+        self.is2dinp_ = is2dinp
+        self.scaler_ = scaler
+
+def get_windows_per_position(inp, samples_shape, vertical, is2dinp):
+    """Windows extracted one position at a time, as done before the strided views"""
+    nrz = samples_shape[-1]
+    samples = np.empty(samples_shape, dtype=inp.dtype)
+    for zidz in range(samples_shape[0]):
+        if vertical:
+            samples[zidz,:,0,0,:] = inp[:,zidz:zidz+nrz]
+        elif is2dinp:
+            for ich in range(inp.shape[0]):
+                samples[zidz] = inp[ich,:,zidz:zidz+nrz]
+        else:
+            samples[zidz] = inp[:,:,:,zidz:zidz+nrz]
+    return samples
+
+window_cases = {
+    '1D_window_5': ((3, 20), 5),
+    '1D_single_window': ((2, 7), 7),
+    '2D_window_4': ((2, 3, 16), [1, 3, 4]),
+    '2D_window_1_trace': ((3, 1, 9), [1, 1, 3]),
+    '3D_window_4': ((2, 3, 5, 12), [3, 5, 4]),
+    '3D_single_window': ((1, 2, 2, 6), [2, 2, 6]),
+}
+
+@pytest.mark.parametrize('inpshape,modelshape', window_cases.values(), ids=window_cases.keys())
+def test_getWindows_matches_per_position_extraction(inpshape, modelshape):
+    from dgbpy import dgbscikit
+    inp = np.random.random(inpshape).astype(np.float32)
+    vertical = isinstance(modelshape, int)
+    is2dinp = len(inpshape) == 3
+    nrz = modelshape if vertical else modelshape[2]
+    samples_shape = dgbhdf5.get_np_shape(modelshape, nrattribs=inp.shape[0], nrpts=inp.shape[-1]-nrz+1)
+    expected = get_windows_per_position(inp, samples_shape, vertical, is2dinp)
+
+    windows = WindowApplierStub(is2dinp).getWindows(inp, samples_shape, vertical)
+    assert windows.shape == expected.shape
+    assert np.array_equal(windows, expected), 'the windows should match the per-position extraction'
+
+    scaler = dgbscikit.getScaler(expected, True)
+    applier = WindowApplierStub(is2dinp, scaler)
+    scaled = applier.scaleWindows(windows, inp, samples_shape, vertical)
+    assert np.allclose(scaled, dgbscikit.scale(expected.copy(), scaler), atol=1e-6), \
+           'scaling the traces should be the same as scaling their windows'
+
+
+def test_message_serves_pipelined_keepalive_requests():
+    sel, message, clientsock = open_loopback(keepalive=True)
+    arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+    requests = encode_request({'action': 'handshake', 'value': {'protocol': 2, 'keepalive': True}}, reqid=1) + \
+               encode_request({'action': 'status'}, reqid=2) + \
+               encode_array_request([arr], reqid=3)
+    responses = exchange(sel, clientsock, requests, 3)
+
+    assert [reqid for reqid, _, _ in responses] == [1, 2, 3], 'the responses should be in the order of the requests'
+    assert decode_json_content(responses[0][2])['keepalive']
+    assert decode_json_content(responses[1][2])['result'] == 'Server online'
+    assert np.array_equal(decode_array_content(responses[2][1], responses[2][2])[0], 2*arr)
+    assert message.sock is not None, 'the persistent connection should stay open'
+
+    responses = exchange(sel, clientsock, encode_request({'action': 'status'}, reqid=4), 1)
+    assert [reqid for reqid, _, _ in responses] == [4]
+    message.close()
+    clientsock.close()
+    sel.close()
+
+
+class PartialSendSocket:
+    """Socket of which sendmsg sends at most maxbytes bytes at a time"""
+    def __init__(self, sock, maxbytes=7):
+        self.sock = sock
+        self.maxbytes = maxbytes
+        self.nrcalls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendmsg(self, buffers):
+        self.nrcalls += 1
+        return self.sock.send(b''.join(bytes(buf) for buf in buffers)[:self.maxbytes])
+
+def test_message_resumes_partial_sends():
+    sel, message, clientsock = open_loopback(sock=PartialSendSocket)
+    arr = np.random.random((3, 1000)).astype(np.float32)
+    responses = exchange(sel, clientsock, encode_array_request([arr]), 1)
+
+    assert message.sock is None, 'the connection should be closed once the response is sent'
+    assert len(responses) == 1
+    (reqid, jsonheader, content) = responses[0]
+    assert len(content) == jsonheader['content-length']
+    assert np.array_equal(decode_array_content(jsonheader, content)[0], 2*arr)
+    clientsock.close()
+    sel.close()
+
+def test_message_shared_memory_round_trip():
+    from multiprocessing import shared_memory, resource_tracker
+    sel, message, clientsock = open_loopback(sharedmem=True)
+    arr = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    inshm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+    try:
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=inshm.buf)[...] = arr
+        request = encode_message(b'', **{'content-type': 'shm/array', 'content-encoding': [arr.dtype.name],
+                                         'array-shape': [arr.shape], 'shm-name': inshm.name})
+        responses = exchange(sel, clientsock, request, 1)
+        assert len(responses) == 1
+        (reqid, jsonheader, content) = responses[0]
+        assert jsonheader['content-type'] == 'shm/array'
+        assert len(content) == 0, 'only the name of the output segment should be sent'
+        assert not message._shms, 'the server should release the segments once the response is sent'
+
+        outshm = shared_memory.SharedMemory(name=jsonheader['shm-name'])
+        try:
+            res = np.ndarray(jsonheader['array-shape'][0], dtype=jsonheader['content-encoding'][0], buffer=outshm.buf)
+            assert np.array_equal(res, 2*arr)
+            del res
+        finally:
+            outshm.close()
+            outshm.unlink()
+    finally:
+        inshm.close()
+        # Unregistered by the server, that runs in this process
+        resource_tracker.register(inshm._name, 'shared_memory')
+        inshm.unlink()
+    clientsock.close()
+    sel.close()
+
+def test_apply_protocol_serves_an_asyncio_request():
+    import threading
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(('localhost', 0))
+    lsock.listen()
+    port = lsock.getsockname()[1]
+    server = threading.Thread(target=applylib.serveAsync, args=(lsock, EchoApplierStub()), daemon=True)
+    server.start()
+
+    arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+    with socket.create_connection(('localhost', port), timeout=10) as sock:
+        sock.sendall(encode_array_request([arr], reqid=7))
+        reqid, jsonheader, content = read_response(sock)
+    assert reqid == 7
+    assert jsonheader['content-type'] == 'binary/array'
+    assert np.array_equal(decode_array_content(jsonheader, content)[0], 2*arr)
+
+    assert send_request(port, {'action': 'kill'})['result'] == 'Kill request received'
+    server.join(timeout=10)
+    assert not server.is_alive(), 'the server should stop after a kill request'
+    lsock.close()
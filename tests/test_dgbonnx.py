@@ -1,7 +1,7 @@
 import sys
 sys.path.insert(0, '..')
 
-import os, pytest
+import glob, os, pytest
 import dgbpy.keystr as dbk
 import dgbpy.dgbkeras as dgbkeras
 import dgbpy.hdf5 as dgbhdf5
@@ -20,6 +20,10 @@ all_data = lambda **kwargs: (
 
 test_data_ids = ['2D_seismic_imgtoimg', '3D_seismic_imgto_img', 'seismic_classification', 'loglog_regression', 'log_classification']
 
+def remove_model(modelfn):
+    for fnm in [modelfn, *glob.glob(os.path.splitext(modelfn)[0]+'.*.opt.onnx')]:
+        os.remove(fnm)
+
 def default_pars():
     pars = dgbkeras.keras_dict
     pars['epochs'] = 1
@@ -66,8 +70,60 @@ def test_onnx_model_one_inattr_one_outattr(data):
 
     assert prediction.shape == yvalid.shape, f"Prediction shape {prediction.shape} does not match yvalid shape {yvalid.shape}"
 
-    os.remove(modelfn)
+    remove_model(modelfn)
+
+
+@pytest.mark.parametrize('batch_size', (1, 3, None))
+def test_onnx_model_batched_run(batch_size):
+    data = get_2d_seismic_imgtoimg_data(nrclasses=5)
+    info = data[dbk.infodictstr]
+    inpshape = info[dbk.inpshapedictstr]
+    shapepar = inpshape[1:] if 1 in inpshape else inpshape
+    make_onnx_model(shapepar, 1, 1, 'channels_first')
+    modelfn = get_model_filename(shapepar)+'.onnx'
+
+    model = dgbonnx.OnnxModel(modelfn)
+    samples = data[dbk.xvaliddictstr]
+    expected = np.concatenate([model(np.expand_dims(sample, axis=0)) for sample in samples])
+    prediction = model.run(samples, batch_size)
+
+    assert prediction.shape == expected.shape
+    assert np.allclose(prediction, expected)
+
+    remove_model(modelfn)
+
+
+def test_onnx_model_session_options():
+    shapepar = [8, 16]
+    make_onnx_model(shapepar, 1, 1, 'channels_first')
+    modelfn = get_model_filename(shapepar)+'.onnx'
 
+    model = dgbonnx.OnnxModel(modelfn, {'intra_op_threads': 1, 'graph_optimization': 'basic'})
+    optfnm = dgbonnx.getOptimizedModelFnm(modelfn, model.pars, dbk.onnxcpustr)
+    assert os.path.isfile(optfnm)
+    assert model.session.get_session_options().intra_op_num_threads == 1
+
+    cached = dgbonnx.OnnxModel(modelfn, {'intra_op_threads': 1, 'graph_optimization': 'basic'})
+    samples = np.random.rand(4, 1, *shapepar).astype('float32')
+    assert np.allclose(cached.run(samples), model.run(samples))
+
+    remove_model(modelfn)
+
+def test_onnx_model_invalid_optimized_cache_is_rebuilt():
+    shapepar = [8, 16]
+    make_onnx_model(shapepar, 1, 1, 'channels_first')
+    modelfn = get_model_filename(shapepar)+'.onnx'
 
+    pars = {'graph_optimization': 'basic'}
+    model = dgbonnx.OnnxModel(modelfn, pars)
+    optfnm = dgbonnx.getOptimizedModelFnm(modelfn, model.pars, dbk.onnxcpustr)
+    with open(optfnm, 'wb') as fp:
+        fp.write(b'truncated')
 
+    model = dgbonnx.OnnxModel(modelfn, pars)
+    assert not os.path.isfile(optfnm), 'an invalid optimized model should be removed'
+    model = dgbonnx.OnnxModel(modelfn, pars)
+    assert os.path.isfile(optfnm), 'the optimized model should be written again'
+    assert not glob.glob(optfnm+'.*.tmp'), 'no temporary file should remain'
 
+    remove_model(modelfn)
@@ -109,4 +109,62 @@ def test_train_default(data):
 #         remove_model_files(filenm)
 
 
-    
\ No newline at end of file
+    
+def test_scale_and_unscale_by_attribute():
+    samples = np.random.random((10, 3, 1, 4, 4)).astype(np.float32)
+    scaler = dgbscikit.getNewScaler([1.0, 2.0, 3.0], [2.0, 0.0, 4.0])
+    scaled = dgbscikit.scale(samples.copy(), scaler)
+    expected = samples.copy()
+    expected[:,0] = (expected[:,0] - 1.0) / 2.0
+    expected[:,1] = expected[:,1] - 2.0
+    expected[:,2] = (expected[:,2] - 3.0) / 4.0
+    assert np.allclose(scaled, expected), 'scaling should be applied per attribute, skipping zero scales'
+    unscaled = dgbscikit.unscale(scaled, scaler)
+    assert np.allclose(unscaled, samples, atol=1e-6), 'unscaling should restore the samples'
+
+def test_nearest_clusters():
+    samples = np.random.random((1000, 5)).astype(np.float32)
+    centers = np.random.random((4, 5))
+    labels, min_distances = dgbscikit.getNearestClusters(samples, centers, blocksize=64)
+    distances = np.linalg.norm(samples[:, np.newaxis, :] - centers[np.newaxis], axis=2)
+    assert np.array_equal(labels, distances.argmin(axis=1)), 'labels should be the nearest centers'
+    assert np.allclose(min_distances, distances.min(axis=1)), 'distances should be to the nearest centers'
+
+def test_spectral_clustering_stores_centers():
+    samples = np.random.random((200, 3)).astype(np.float32)
+    model = SpectralClustering(2).fit(samples)
+    dgbscikit.setClusterCenters(model, samples)
+    assert model.cluster_centers_.shape == (2, 3), 'one center per cluster should be stored'
+    labels = dgbscikit.predictClusters(model, samples)
+    assert labels.shape == (200,), 'each sample should get a cluster label'
+    distances = dgbscikit.getClusterDistances(model, samples)
+    assert distances.min() == 0 and distances.max() == 1, 'distances should be normalized'
+
+def test_onnx_model_predict_with_proba_uses_one_session(tmp_path):
+    import onnxruntime as rt
+    from sklearn.linear_model import LogisticRegression
+    from dgbpy.sklearn_classes import OnnxScikitModel
+    data = get_loglog_classification_data(flatten=True)
+    model = LogisticRegression().fit(data[dbk.xtraindictstr], data[dbk.ytraindictstr].ravel().astype(np.int64))
+    onnxfnm = str(tmp_path / 'model.onnx')
+    with open(onnxfnm, 'wb') as file:
+        file.write(dgbscikit.onnx_from_sklearn(model).SerializeToString())
+
+    onnxmodel = OnnxScikitModel(onnxfnm, intra_op_threads=1, inter_op_threads=1)
+    samples = data[dbk.xvaliddictstr]
+    labels, probs = onnxmodel.predict_with_proba(samples)
+    session = onnxmodel.session
+    assert onnxmodel.session is session, 'the session should be created once'
+    assert session.get_session_options().intra_op_num_threads == 1
+    assert session.get_session_options().inter_op_num_threads == 1
+
+    def run_on_new_session(outidx):
+        sess = rt.InferenceSession(onnxfnm)
+        outnm = sess.get_outputs()[outidx].name
+        return np.squeeze(sess.run([outnm], {sess.get_inputs()[0].name: samples.astype(np.single)})[0])
+
+    assert np.array_equal(labels, run_on_new_session(0))
+    assert np.allclose(probs, run_on_new_session(1))
+    assert np.array_equal(onnxmodel.predict(samples), labels)
+    assert np.allclose(onnxmodel.predict_proba(samples), probs)
+    assert onnxmodel.session is session
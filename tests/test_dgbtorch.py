@@ -79,7 +79,7 @@ def test_training_parameters():
     assert isinstance(pars, dict)
     for key, value in pars.items():
         assert isinstance(key, str)
-        if key in ['nbchunk', 'epochs', 'patience', 'epochdrop', 'nbfold', 'batch']:
+        if key in ['nbchunk', 'epochs', 'patience', 'epochdrop', 'nbfold', 'batch', 'nbworkers']:
             assert isinstance(value, int) and not isinstance(
                 value, bool
             ), f'{key} must be an integer'
@@ -91,7 +91,7 @@ def test_training_parameters():
             assert isinstance(value, str)
         elif key in ['type']:
             assert isinstance(value, str) or value is None
-        elif key in [dbk.prefercpustr, 'withtensorboard', 'tofp16']:
+        elif key in [dbk.prefercpustr, 'withtensorboard', 'tofp16', 'streaming', 'prefetch', 'batchsampler']:
             assert isinstance(value, bool)
         elif key in ['transform']:
             assert isinstance(value, list)
@@ -159,6 +159,16 @@ def test_train_default(data):
         ), 'model should have been trained'
 
 
+@pytest.mark.parametrize('data', all_data(), ids=test_data_ids)
+def test_train_with_batch_sampler(data):
+    pars = default_pars()
+    pars['batchsampler'] = True
+    info = data[dbk.infodictstr]
+    model = get_default_model(info)
+    modelarch = get_model_arch(info, model, 0)
+    trained_model = dgbtorch.train(modelarch, data, pars)
+    assert isinstance(trained_model, nn.Module), 'model should be a nn.Module'
+
 @pytest.mark.parametrize('data', (get_2d_seismic_imgtoimg_data(),))
 def test_train_with_tensorboard(data):
     pars = default_pars()
@@ -316,6 +326,72 @@ def test_apply_result_dictionary(data):
     os.remove(f'{filename}.onnx')
 
 
+@pytest.mark.parametrize('data',
+                         (get_seismic_classification_data(), get_loglog_data()),
+                         ids=['seismic_classification', 'loglog'])
+def test_apply_result____partial_last_batch_should_return_all_samples(data):
+    pars = default_pars()
+    info = data[dbk.infodictstr]
+    model = get_default_model(info)
+    modelarch = get_model_arch(info, model, 0)
+    model = dgbtorch.train(modelarch, data, pars, silent=True)
+
+    samples = data[dbk.xvaliddictstr]
+    batch_size = 4
+    samples = samples[:batch_size+1] if len(samples) > batch_size+1 else samples
+    isclassification = info[dbk.classdictstr]
+    pred = dgbtorch.apply(model, info, samples, None, isclassification, True, [], False, False, batch_size)
+
+    assert len(pred[dbk.preddictstr]) == len(samples), 'all samples should be predicted'
+
+
+@pytest.mark.parametrize('data',
+                         (get_seismic_classification_data(), get_loglog_data()),
+                         ids=['seismic_classification', 'loglog'])
+def test_apply_result____batched_output_should_match_a_single_batch(data):
+    pars = default_pars()
+    info = data[dbk.infodictstr]
+    model = get_default_model(info)
+    modelarch = get_model_arch(info, model, 0)
+    model = dgbtorch.train(modelarch, data, pars, silent=True)
+
+    samples = data[dbk.xvaliddictstr]
+    isclassification = info[dbk.classdictstr]
+    withprobs = list(range(dgbhdf5.getNrClasses(info))) if isclassification else []
+    doprobabilities = len(withprobs) > 0
+    expected = dgbtorch.apply(model, info, samples, None, isclassification, True, withprobs,
+                              isclassification, doprobabilities, len(samples))
+    pred = dgbtorch.apply(model, info, samples, None, isclassification, True, withprobs,
+                          isclassification, doprobabilities, 3)
+
+    assert set(pred) == set(expected)
+    for key in pred:
+        assert pred[key].shape == expected[key].shape, f'{key} should have one entry per sample'
+        assert pred[key].dtype == expected[key].dtype
+        assert np.allclose(pred[key], expected[key], atol=1e-5), f'{key} should not depend on the batch size'
+
+
+def test_apply_result____classification_with_outbuffers_should_reuse_them():
+    data = get_seismic_classification_data()
+    pars = default_pars()
+    info = data[dbk.infodictstr]
+    model = get_default_model(info)
+    modelarch = get_model_arch(info, model, 0)
+    model = dgbtorch.train(modelarch, data, pars, silent=True)
+
+    samples = data[dbk.xvaliddictstr]
+    withprobs = list(range(dgbhdf5.getNrClasses(info)))
+    expected = dgbtorch.apply(model, info, samples, None, True, True, withprobs, True, True)
+
+    outbuffers = {}
+    for _ in range(2):
+        pred = dgbtorch.apply(model, info, samples, None, True, True, withprobs, True, True, out=outbuffers)
+        assert set(pred) == set(expected)
+        for key in pred:
+            assert np.shares_memory(pred[key], outbuffers[key]), f'{key} should use the output buffer'
+            assert np.array_equal(pred[key], expected[key]), f'{key} should not depend on the output buffers'
+
+
 @pytest.mark.parametrize('data',
                          (get_2d_seismic_imgtoimg_data(nrclasses=5), get_3d_seismic_imgtoimg_data(nrclasses=5)),
                          ids=['2D_seismic_imgtoimg', '3D_seismic_imgto_img'])
@@ -502,3 +578,62 @@ def test_train_and_apply_multiple_in_and_out_attributes(data):
     assert prediction.shape == yvalid.shape, 'prediction shape should be the same as the target shape'
 
 
+
+class IndexedStreamingDataset(tc.StreamingDatasetClass):
+    """Streaming dataset returning the transform index of each sample as its data"""
+    def get_samples(self, X, Y, idxs):
+        shape = (-1,) + (1,)*(X.ndim-1)
+        return np.broadcast_to(np.asarray(idxs, dtype='float32').reshape(shape), X.shape).copy(), Y
+
+def get_indexed_cubelets(info, collection, groupnm):
+    ids = np.asarray(next(iter(collection.values())))
+    return {
+        dbk.xtraindictstr: np.zeros((len(ids), 1, 1, 8, 8), dtype='float32'),
+        dbk.ytraindictstr: ids.astype('float32').reshape(-1, 1),
+    }
+
+def iterate_streaming_epoch(dataset, nbworkers):
+    from torch.utils.data import DataLoader
+    ids, idxs = [], []
+    for X, y in DataLoader(dataset, batch_size=None, num_workers=nbworkers):
+        ids.append(int(y[0]))
+        idxs.append(int(X.flatten()[0]))
+    return ids, idxs
+
+def test_streaming_dataset_with_workers_should_shuffle_every_epoch(monkeypatch):
+    monkeypatch.setattr(dgbhdf5, 'getCubeLets', get_indexed_cubelets)
+    info = copy.deepcopy(get_seismic_classification_info())
+    info[dbk.classdictstr] = False
+    nrpts = 40
+    dataset = IndexedStreamingDataset({dbk.infodictstr: info}, None, blocksize=4)
+    dataset.set_blocks({'group': {'collection': np.arange(nrpts)}})
+
+    epochs = []
+    for _ in range(2):
+        dataset.set_transform_seed()
+        ids, idxs = iterate_streaming_epoch(dataset, nbworkers=2)
+        assert sorted(ids) == list(range(nrpts)), 'each sample should be read once per epoch'
+        assert sorted(idxs) == list(range(nrpts)), 'the workers should not share transform indices'
+        epochs.append(ids)
+    assert epochs[0] != epochs[1], 'the sample order should change between epochs'
+    assert epochs[1] == iterate_streaming_epoch(dataset, nbworkers=2)[0], 'the order should only depend on the epoch'
+
+class PrefetcherStub:
+    def __init__(self, chunk):
+        self.chunk = chunk
+
+    def get(self, ichunk, ifold=1):
+        return self.chunk
+
+def test_prefetched_chunk_should_not_be_copied():
+    data = get_seismic_classification_data()
+    chunk = {key: value.astype('float32') if isinstance(value, np.ndarray) else value for key, value in data.items()}
+    train_dataset = tc.TrainDatasetClass(data, dbk.globalstdtypestr)
+    test_dataset = tc.TestDatasetClass(data, dbk.globalstdtypestr)
+    for dataset, key in ((train_dataset, dbk.xtraindictstr), (test_dataset, dbk.xvaliddictstr)):
+        dataset.prefetcher = PrefetcherStub(chunk)
+        dataset.set_fold(0, 1)
+        assert np.shares_memory(dataset.X, chunk[key]), 'the prefetched float32 chunk should be used as is'
+
+    train_dataset.set_chunk(0)
+    assert not np.shares_memory(train_dataset.X, data[dbk.xtraindictstr]), 'the caller data should be copied'
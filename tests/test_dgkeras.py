@@ -68,7 +68,7 @@ def test_training_parameters():
             assert isinstance(value, str)
         elif key in ['type']:
             assert isinstance(value, bool) or value is None
-        elif key in [dbk.prefercpustr, 'withtensorboard', 'tofp16']:
+        elif key in [dbk.prefercpustr, 'withtensorboard', 'tofp16', 'prefetch']:
             assert isinstance(value, bool)
         elif key in ['transform']:
             assert isinstance(value, list)
@@ -0,0 +1,54 @@
+import sys
+sys.path.insert(0, '..')
+
+import h5py
+import pytest
+import numpy as np
+import dgbpy.keystr as dbk
+import dgbpy.hdf5 as dgbhdf5
+from init_data import *
+
+nrexamples = 40
+selections = {
+    'dense_unsorted_duplicates': [5, 3, 4, 3, 5],
+    'sparse_unsorted_duplicates': [37, 2, 2, 19, 0, 37],
+}
+
+def write_examples(filenm, groupnm='Dummy', collnm='Dummy'):
+    x_data = np.arange(nrexamples, dtype=np.float32).reshape((nrexamples, 1, 1, 1, 1))
+    y_data = 10*np.arange(nrexamples, dtype=np.float32).reshape((nrexamples, 1))
+    with h5py.File(filenm, 'w') as h5file:
+        grp = h5file.create_group(groupnm).create_group(collnm)
+        grp.create_dataset(dbk.xdatadictstr, data=x_data)
+        grp.create_dataset(dbk.ydatadictstr, data=y_data)
+    return x_data, y_data
+
+@pytest.mark.parametrize('dsetnms', selections.values(), ids=selections.keys())
+def test_readSelection_restores_the_requested_order(tmp_path, dsetnms):
+    filenm = str(tmp_path / 'examples.h5')
+    x_data, y_data = write_examples(filenm)
+    with h5py.File(filenm, 'r') as h5file:
+        grp = h5file['Dummy']['Dummy']
+        inputs = np.empty((len(dsetnms),)+x_data.shape[1:], dtype=np.float32)
+        outputs = np.empty((len(dsetnms), 1), dtype=np.float32)
+        assert dgbhdf5.readSelection(grp[dbk.xdatadictstr], dsetnms, inputs)
+        assert dgbhdf5.readSelection(grp[dbk.ydatadictstr], dsetnms, outputs, asis=True)
+    assert np.array_equal(inputs, x_data[dsetnms]), 'the examples should be in the requested order'
+    assert np.array_equal(outputs, y_data[dsetnms])
+
+def test_readSelection_refuses_out_of_range_selection(tmp_path):
+    filenm = str(tmp_path / 'examples.h5')
+    write_examples(filenm)
+    with h5py.File(filenm, 'r') as h5file:
+        arr = np.empty((2, 1), dtype=np.float32)
+        assert not dgbhdf5.readSelection(h5file['Dummy']['Dummy'][dbk.ydatadictstr], [3, nrexamples], arr)
+
+@pytest.mark.parametrize('dsetnms', selections.values(), ids=selections.keys())
+def test_getCubeLets_bulk_read(tmp_path, dsetnms):
+    filenm = str(tmp_path / 'examples.h5')
+    x_data, y_data = write_examples(filenm)
+    info = get_default_info()
+    info[dbk.filedictstr] = filenm
+    cubelets = dgbhdf5.getCubeLets(info, {'Dummy': dsetnms}, 'Dummy')
+    assert np.array_equal(cubelets[dbk.xtraindictstr], x_data[dsetnms])
+    assert np.array_equal(cubelets[dbk.ytraindictstr], y_data[dsetnms])
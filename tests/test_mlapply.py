@@ -5,6 +5,7 @@ import os
 import fnmatch, pytest
 import dgbpy.keystr as dbk
 import dgbpy.mlapply as dgbml
+import dgbpy.mlio as dgbmlio
 from init_data import *
 from test_dgkeras import default_pars as keras_params
 from test_dgbscikit import default_pars as scikit_params
@@ -168,3 +169,36 @@ def cleanup_after_tests(request):
     request.addfinalizer(finalizer)
 
 
+@pytest.mark.parametrize('dtype', ('float16', 'float32'))
+@pytest.mark.parametrize('shape,axis', (((20, 5), 1), ((5, 20), 0), ((6, 4, 3, 7), 1)))
+def test_getClassificationResults(shape, axis, dtype):
+    probs = np.random.rand(*shape).astype(dtype)
+    res = dgbmlio.getClassificationResults(probs, True, [0, 2], True, axis=axis)
+
+    sortedprobs = np.sort(probs, axis=axis)
+    assert np.array_equal(res[dbk.preddictstr], np.argmax(probs, axis=axis, keepdims=True))
+    assert np.array_equal(res[dbk.probadictstr], np.take(probs, [0, 2], axis=axis))
+    assert res[dbk.confdictstr].dtype == probs.dtype
+    assert np.array_equal(res[dbk.confdictstr],
+                          np.take(sortedprobs, [-1], axis=axis) - np.take(sortedprobs, [-2], axis=axis))
+
+    out = {dbk.preddictstr: np.empty(res[dbk.preddictstr].shape, dtype=np.uint8)}
+    outres = dgbmlio.getClassificationResults(probs, True, axis=axis, out=out)
+    assert outres[dbk.preddictstr] is out[dbk.preddictstr]
+    assert np.array_equal(outres[dbk.preddictstr], res[dbk.preddictstr])
+
+
+def test_getClassificationResults_reuses_out():
+    out = {}
+    probs = np.random.rand(20, 5).astype('float32')
+    res = dgbmlio.getClassificationResults(probs, True, [1], True, axis=1, out=out)
+    assert all(res[key] is out[key] for key in res)
+
+    newprobs = np.random.rand(20, 5).astype('float32')
+    newres = dgbmlio.getClassificationResults(newprobs, True, [1], True, axis=1, out=out)
+    assert all(newres[key] is res[key] for key in res)
+    assert np.array_equal(newres[dbk.preddictstr], np.argmax(newprobs, axis=1, keepdims=True))
+
+    smallres = dgbmlio.getClassificationResults(newprobs[:8], True, axis=1, out=out)
+    assert smallres[dbk.preddictstr].shape == (8, 1)
+    assert out[dbk.preddictstr] is smallres[dbk.preddictstr]